@@ -3,14 +3,20 @@ import os
 import logging
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from handlers.common import common_router
+from handlers.common import common_router, ai_service
 from handlers.rating import rating_router
 from database.create_tables import create_tables
+from database.database import init_db, close_db
+from database.fsm_storage import SQLiteStorage
+from database.models import rating_writer, message_writer
 from handlers.onboarding import onboarding_router 
 from handlers.admin import admin_router
 from config.settings import settings
-from services.session_analyzer import start_session_analyzer, add_message_to_session
+from services.session_analyzer import start_session_analyzer, add_message_to_session, restore_sessions
+from services.session_analyzer import set_client as set_analyzer_client
+from services.llm_client import create_llm_client
+from services.broadcaster import resume_broadcasts, stop_broadcasts
+from services.scheduler import scheduler
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, 
@@ -24,12 +30,21 @@ load_dotenv()
 TG_TOKEN = os.getenv('TG_TOKEN')
 
 async def main():
+    kb_watcher = None
     try:
+        # Открываем пул соединений с базой данных
+        await init_db()
+        
         # Создаем таблицы в базе данных
         await create_tables()
         
-        # Создаем хранилище состояний для FSM
-        storage = MemoryStorage()
+        # Создаем общий клиент OpenAI с пулом соединений для всех сервисов
+        llm_client = create_llm_client()
+        ai_service.set_client(llm_client)
+        set_analyzer_client(llm_client)
+        
+        # Создаем хранилище состояний для FSM (состояния сохраняются в базе и переживают перезапуск)
+        storage = SQLiteStorage()
         
         # Создаем экземпляры бота и диспетчера
         bot = Bot(token=TG_TOKEN)
@@ -43,6 +58,19 @@ async def main():
         dp.include_router(common_router)
         dp.include_router(rating_router)
         
+        # Запускаем планировщик отложенных задач (запросы оценок), восстанавливая сохраненные таймеры
+        await scheduler.start(bot)
+        
+        # Продолжаем рассылки, прерванные предыдущей остановкой бота
+        await resume_broadcasts(bot)
+        
+        # Следим за изменениями базы знаний и системного промпта, чтобы обновлять их без перезапуска
+        if settings.KB_RELOAD_INTERVAL:
+            kb_watcher = asyncio.create_task(ai_service.watch_knowledge_base())
+        
+        # Восстанавливаем сессии, которые не успели проанализировать до остановки бота
+        await restore_sessions()
+        
         # Запускаем анализатор сессий в отдельной задаче
         asyncio.create_task(start_session_analyzer(bot))
         logger.info('Session analyzer started')
@@ -52,9 +80,23 @@ async def main():
     except Exception as ex:
         logger.error(f'Error starting bot: {ex}', exc_info=True)
     finally:
-        # Закрываем сессию бота при выходе
+        # Останавливаем слежение за базой знаний
+        if kb_watcher is not None:
+            kb_watcher.cancel()
+            await asyncio.gather(kb_watcher, return_exceptions=True)
+        # Затем останавливаем рассылки и планировщик и дописываем накопленные в очередях записи:
+        # отменяемые рассылки и выполняющиеся таймеры еще обращаются к Telegram
+        await stop_broadcasts()
+        await scheduler.stop()
+        await message_writer.stop()
+        await rating_writer.stop()
+        # Закрываем соединения клиента OpenAI
+        if 'llm_client' in locals():
+            await llm_client.close()
+        # Сессию бота закрываем последней перед соединениями с базой данных
         if 'bot' in locals():
             await bot.session.close()
+        await close_db()
 
 if __name__ == '__main__':
     try:
@@ -12,6 +12,97 @@ class Settings(BaseSettings):
     
     # Настройки бота
     RATING_TIME: int = 5  # минуты
+    RATING_PROMPT_DELAY: int = 180  # секунды до запроса оценки ответа
+    RATING_SESSION_TIMEOUT: int = 600  # секунды ожидания оценки после запроса
+    STREAM_ANSWERS: bool = True  # отправлять ответ по мере генерации
+    STREAM_EDIT_INTERVAL: float = 1.0  # секунды между редактированиями сообщения
+    STREAM_FINAL_EDIT_RETRIES: int = 3  # попыток вывести окончательный текст, после которых он отправляется новым сообщением
+    MESSAGE_DEBOUNCE: float = 1.0  # секунды ожидания следующего сообщения, если пользователь пишет несколько подряд
+    
+    # Настройки анализа диалогов
+    LEAD_ANALYSIS_WORKERS: int = 4  # воркеров, анализирующих сессии параллельно
+    LEAD_ANALYSIS_MAX_CONCURRENT_REQUESTS: int = 4  # одновременных запросов к OpenAI от анализатора
+    LEAD_ANALYSIS_MAX_RETRIES: int = 3
+    LEAD_ANALYSIS_RETRY_DELAY: float = 2.0  # базовая задержка повтора, секунды
+    LEAD_DEAD_LETTER_SIZE: int = 1000  # сколько неудачных сессий хранить для повторного анализа
+    LEAD_DEAD_LETTER_RETRY_INTERVAL: int = 900  # секунды между повторными анализами неудачных сессий
+    LEAD_DEAD_LETTER_MAX_ATTEMPTS: int = 3  # попыток анализа одной сессии, после которых она отбрасывается
+    LEAD_BATCH_SIZE: int = 5  # диалогов в одном запросе пакетного анализа
+    SESSION_RESTORE_WINDOW: int = 86400  # за сколько секунд восстанавливать непроанализированные сессии при запуске
+    
+    # Настройки рассылок
+    BROADCAST_RATE: float = 25.0  # сообщений в секунду (глобальный лимит Telegram - около 30)
+    BROADCAST_CONCURRENCY: int = 10  # одновременных отправок
+    BROADCAST_MAX_RETRIES: int = 3  # повторов после RetryAfter
+    BROADCAST_PROGRESS_INTERVAL: float = 5.0  # секунды между обновлениями прогресса
+    BROADCAST_BATCH_SIZE: int = 200  # получателей, выбираемых из базы за один запрос
+    
+    # Настройки базы данных
+    DB_READ_POOL_SIZE: int = 4  # соединений для чтения
+    DB_CACHE_SIZE_KB: int = 16384  # размер кэша страниц SQLite на соединение
+    DB_BUSY_TIMEOUT_MS: int = 5000
+    
+    # Настройки хранилища состояний FSM
+    FSM_STATE_TTL: int = 604800  # секунды, после которых неизменное состояние удаляется (7 дней)
+    FSM_CACHE_SIZE: int = 10000  # записей в кэше в памяти
+    FSM_PURGE_INTERVAL: int = 3600  # секунды между очистками устаревших состояний
+    
+    # Настройки клиента OpenAI
+    OPENAI_MAX_CONNECTIONS: int = 50
+    OPENAI_MAX_KEEPALIVE: int = 20
+    OPENAI_KEEPALIVE_EXPIRY: float = 60.0  # секунды
+    OPENAI_TIMEOUT: float = 60.0  # секунды
+    OPENAI_CONNECT_TIMEOUT: float = 10.0  # секунды
+    OPENAI_MAX_RETRIES: int = 3
+    
+    # Настройки базы знаний
+    KB_FILE_PATH: str = "base/Baza_cf.txt"
+    KB_INDEX_DIR: str = "base/index_cache"  # каталог с сохраненными FAISS-индексами
+    SYSTEM_PROMPT_PATH: str = "base/system_prompt.txt"  # системный промпт со ссылками на курсы
+    KB_RELOAD_INTERVAL: float = 30.0  # секунды между проверками изменений файлов базы знаний (0 - не проверять)
+    KB_CHUNKING: str = "sections"  # "sections" - по заголовкам с метаданными, "plain" - фиксированными отрезками
+    KB_CHUNK_SIZE: int = 1200  # символов в отрезке
+    KB_CHUNK_OVERLAP: int = 150
+    KB_RETRIEVAL_MODE: str = "mmr"  # "mmr" - с отбором непохожих отрезков, "similarity" - ближайшие отрезки
+    KB_RETRIEVAL_K: int = 6  # отрезков в контексте ответа
+    KB_FETCH_K: int = 20  # кандидатов для отбора MMR
+    KB_MMR_LAMBDA: float = 0.5  # 1 - только релевантность, 0 - только разнообразие
+    KB_MAX_DISTANCE: float = 0.5  # максимальное расстояние до отрезка (0 - без порога)
+    KB_LEXICAL_ENABLED: bool = True  # объединять результаты BM25 и FAISS
+    KB_LEXICAL_SKIP_EMBEDDING: bool = True  # не запрашивать эмбеддинг при уверенном результате BM25
+    KB_LEXICAL_CONFIDENCE: float = 0.7  # порог уверенности BM25 (доля максимально возможной оценки)
+    KB_RRF_K: int = 60  # константа сглаживания в reciprocal rank fusion
+    KB_EMBEDDING_TIMEOUT: float = 5.0  # секунды ожидания эмбеддинга, после которых используется только BM25
+    EMBEDDING_MODEL: str = "text-embedding-ada-002"
+    RETRIEVAL_THREADS: int = 4  # потоки для поиска по FAISS
+    RETRIEVAL_MAX_CONCURRENCY: int = 8  # одновременных запросов к базе знаний
+    
+    # Настройки кэширования
+    EMBEDDING_CACHE_SIZE: int = 2000
+    EMBEDDING_CACHE_TTL: int = 86400  # секунды
+    ANSWER_CACHE_SIZE: int = 500
+    ANSWER_CACHE_TTL: int = 21600  # секунды
+    ANSWER_CACHE_THRESHOLD: float = 0.97  # минимальная косинусная близость вопросов
+    
+    # Объединение одинаковых одновременных вопросов
+    SINGLE_FLIGHT_TIMEOUT: float = 30.0  # секунды, в течение которых к запросу можно присоединиться и ждать его
+    
+    # Ограничение нагрузки на модель
+    LLM_MAX_CONCURRENCY: int = 20  # одновременных запросов ответа к OpenAI
+    LLM_QUEUE_SIZE: int = 100  # вопросов в очереди; при заполненной очереди отвечаем сразу без модели
+    LLM_QUEUE_TIMEOUT: float = 15.0  # секунды ожидания места в очереди
+    OVERLOAD_ANSWER_THRESHOLD: float = 0.9  # минимальная близость вопроса к ответу из кэша при перегрузке
+    OVERLOAD_MESSAGE: str = "Сейчас мне пишет очень много людей 🙈 Пожалуйста, повторите вопрос через пару минут."
+    
+    # Бюджет токенов промпта
+    PROMPT_TOKEN_BUDGET: int = 6000  # токенов на весь промпт: системный, контекст, история и вопрос
+    PROMPT_HISTORY_TOKEN_BUDGET: int = 1500  # токенов на историю диалога
+    
+    # Настройки памяти диалогов
+    CONVERSATION_HISTORY_TURNS: int = 3  # последних ходов диалога в памяти и в промпте
+    CONVERSATION_MAX_USERS: int = 5000  # пользователей, чья история держится в памяти
+    CONVERSATION_IDLE_TTL: int = 86400  # секунды бездействия, после которых история выгружается
+    CONVERSATION_RESTORE_FROM_DB: bool = True  # восстанавливать выгруженную историю из таблицы messages
     
     class Config:
         env_file = ".env"
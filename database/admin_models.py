@@ -1,31 +1,24 @@
-from database.database import get_db_connection
+from database.database import get_connection
 
 async def get_users_count():
-    conn = await get_db_connection()
-    try:
+    async with get_connection() as conn:
         async with conn.cursor() as cursor:
             await cursor.execute('SELECT COUNT(*) FROM users')
             result = await cursor.fetchone()
             return result[0] if result else 0
-    finally:
-        await conn.close()
 
 
 async def get_messages_count():
-    conn = await get_db_connection()
-    try:
+    async with get_connection() as conn:
         async with conn.cursor() as cursor:
             await cursor.execute('SELECT COUNT(*) FROM messages')
             result = await cursor.fetchone()
             return result[0] if result else 0
-    finally:
-        await conn.close()
         
 
 async def get_ratings_stats():
     """Возвращает статистику по оценкам"""
-    conn = await get_db_connection()
-    try:
+    async with get_connection() as conn:
         async with conn.cursor() as cursor:
             # Общее количество оценок
             await cursor.execute('SELECT COUNT(*) FROM ratings')
@@ -44,33 +37,24 @@ async def get_ratings_stats():
                 "avg_rating": round(avg_rating[0], 2) if avg_rating and avg_rating[0] else 0,
                 "distribution": {row[0]: row[1] for row in distribution} if distribution else {}
             }
-    finally:
-        await conn.close()
         
 async def get_all_users():
-    conn = await get_db_connection()
-    try:
+    async with get_connection() as conn:
         async with conn.cursor() as cursor:
             await cursor.execute('SELECT user_id, username, first_name, last_name, time_added FROM users ORDER BY time_added DESC')
             users = await cursor.fetchall()
             return users
-    finally:
-        await conn.close()
         
 async def get_all_user_ids():
-    conn = await get_db_connection()
-    try:
+    async with get_connection() as conn:
         async with conn.cursor() as cursor:
             await cursor.execute('SELECT user_id FROM users')
             user_ids = await cursor.fetchall()
             return [row[0] for row in user_ids]
-    finally:
-        await conn.close()
         
 async def get_users_by_segment(country=None, interests=None, subject=None):
     """Получает список пользователей по сегментам"""
-    conn = await get_db_connection()
-    try:
+    async with get_connection() as conn:
         async with conn.cursor() as cursor:
             query = 'SELECT user_id FROM users WHERE 1=1'
             params = []
@@ -90,13 +74,10 @@ async def get_users_by_segment(country=None, interests=None, subject=None):
             await cursor.execute(query, params)
             user_ids = await cursor.fetchall()
             return [row[0] for row in user_ids]
-    finally:
-        await conn.close()
         
 async def get_available_segments():
     """Получает доступные сегменты для фильтрации"""
-    conn = await get_db_connection()
-    try:
+    async with get_connection() as conn:
         async with conn.cursor() as cursor:
             # Получаем уникальные страны
             await cursor.execute('SELECT DISTINCT country FROM users WHERE country IS NOT NULL')
@@ -122,13 +103,10 @@ async def get_available_segments():
                 "subjects": [row[0] for row in subjects],
                 "interests": list(interests_set)
             }
-    finally:
-        await conn.close()
         
 async def get_users_by_segment(country=None, interests=None, subject=None):
     """Получает список пользователей по сегментам"""
-    conn = await get_db_connection()
-    try:
+    async with get_connection() as conn:
         async with conn.cursor() as cursor:
             query = 'SELECT user_id FROM users WHERE 1=1'
             params = []
@@ -148,35 +126,67 @@ async def get_users_by_segment(country=None, interests=None, subject=None):
             await cursor.execute(query, params)
             user_ids = await cursor.fetchall()
             return [row[0] for row in user_ids]
-    finally:
-        await conn.close()
         
 async def delete_user(user_id):
     """Удаляет пользователя из базы данных по его user_id"""
-    conn = await get_db_connection()
     try:
-        async with conn.cursor() as cursor:
-            # Сначала удаляем связанные записи из таблицы ratings
-            await cursor.execute('''
-                DELETE FROM ratings WHERE user_id = ?
-            ''', (user_id,))
+        async with get_connection(write=True) as conn:
+            async with conn.cursor() as cursor:
+                # Сначала удаляем связанные записи из таблицы ratings
+                await cursor.execute('''
+                    DELETE FROM ratings WHERE user_id = ?
+                ''', (user_id,))
             
-            # Затем удаляем связанные записи из таблицы messages
-            await cursor.execute('''
-                DELETE FROM messages WHERE user_id = ?
-            ''', (user_id,))
+                # Затем удаляем связанные записи из таблицы messages
+                await cursor.execute('''
+                    DELETE FROM messages WHERE user_id = ?
+                ''', (user_id,))
             
-            # Наконец, удаляем самого пользователя
-            await cursor.execute('''
-                DELETE FROM users WHERE user_id = ?
-            ''', (user_id,))
+                # Наконец, удаляем самого пользователя
+                await cursor.execute('''
+                    DELETE FROM users WHERE user_id = ?
+                ''', (user_id,))
             
-            await conn.commit()
+                await conn.commit()
             
-            # Возвращаем количество удаленных строк
-            return cursor.rowcount
+                # Возвращаем количество удаленных строк
+                return cursor.rowcount
     except Exception as e:
         print(f"Ошибка при удалении пользователя: {e}")
         return 0
-    finally:
-        await conn.close()
+
+def segment_filter(segment_type=None, segment_value=None):
+    """Возвращает условие WHERE и параметры для выбранного сегмента рассылки"""
+    if segment_type == "country":
+        return 'country = ?', [segment_value]
+    if segment_type == "interests":
+        return 'interests LIKE ?', [f'%{segment_value}%']
+    if segment_type == "subject":
+        return 'subject = ?', [segment_value]
+    return '1=1', []
+
+async def count_users_in_segment(segment_type=None, segment_value=None):
+    """Возвращает количество пользователей в сегменте"""
+    condition, params = segment_filter(segment_type, segment_value)
+    async with get_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(f'SELECT COUNT(*) FROM users WHERE {condition}', params)
+            result = await cursor.fetchone()
+            return result[0] if result else 0
+
+async def get_segment_user_ids_page(segment_type=None, segment_value=None, after_user_id=0, limit=200):
+    """
+    Возвращает следующую страницу ID пользователей сегмента по возрастанию user_id.
+    
+    Постраничная выборка по ключу (user_id > after_user_id) не требует OFFSET
+    и позволяет продолжить обход с сохраненного места.
+    """
+    condition, params = segment_filter(segment_type, segment_value)
+    async with get_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                f'SELECT user_id FROM users WHERE user_id > ? AND {condition} ORDER BY user_id LIMIT ?',
+                [after_user_id] + params + [limit]
+            )
+            rows = await cursor.fetchall()
+            return [row[0] for row in rows]
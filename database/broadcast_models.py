@@ -0,0 +1,103 @@
+from datetime import datetime
+from database.database import get_connection
+
+# Функции для работы с рассылками и журналом доставки
+
+async def create_broadcast_job(text, segment_type, segment_value, segment_description, admin_chat_id, progress_message_id):
+    """Создает задание рассылки и возвращает его ID"""
+    created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    async with get_connection(write=True) as conn:
+        cursor = await conn.execute('''
+            INSERT INTO broadcast_jobs (text, segment_type, segment_value, segment_description,
+                                        admin_chat_id, progress_message_id, status, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, 'running', ?)
+        ''', (text, segment_type, segment_value, segment_description, admin_chat_id, progress_message_id, created_at))
+        await conn.commit()
+        return cursor.lastrowid
+
+async def get_broadcast_job(job_id):
+    """Возвращает задание рассылки в виде словаря"""
+    async with get_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute('''
+                SELECT id, text, segment_type, segment_value, segment_description,
+                       admin_chat_id, progress_message_id, status, last_user_id
+                FROM broadcast_jobs WHERE id = ?
+            ''', (job_id,))
+            row = await cursor.fetchone()
+            if not row:
+                return None
+            keys = ('id', 'text', 'segment_type', 'segment_value', 'segment_description',
+                    'admin_chat_id', 'progress_message_id', 'status', 'last_user_id')
+            return dict(zip(keys, row))
+
+async def get_running_broadcast_job_ids():
+    """Возвращает ID незавершенных рассылок (например, прерванных перезапуском)"""
+    async with get_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+            rows = await cursor.fetchall()
+            return [row[0] for row in rows]
+
+async def add_broadcast_recipients(job_id, user_ids):
+    """
+    Добавляет получателей в журнал доставки и возвращает тех, кому сообщение еще не отправлялось.
+    Уже записанные получатели (при продолжении прерванной рассылки) не дублируются.
+    """
+    updated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    async with get_connection(write=True) as conn:
+        await conn.executemany('''
+            INSERT OR IGNORE INTO broadcast_recipients (job_id, user_id, status, updated_at)
+            VALUES (?, ?, 'pending', ?)
+        ''', [(job_id, user_id, updated_at) for user_id in user_ids])
+        await conn.commit()
+        
+        placeholders = ','.join('?' * len(user_ids))
+        cursor = await conn.execute(f'''
+            SELECT user_id FROM broadcast_recipients
+            WHERE job_id = ? AND status = 'pending' AND user_id IN ({placeholders})
+            ORDER BY user_id
+        ''', [job_id] + list(user_ids))
+        rows = await cursor.fetchall()
+        return [row[0] for row in rows]
+
+async def set_recipient_statuses(records):
+    """
+    Сохраняет результаты доставки.
+    
+    Args:
+        records (list): Кортежи (job_id, user_id, status, error)
+    """
+    updated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    async with get_connection(write=True) as conn:
+        await conn.executemany('''
+            UPDATE broadcast_recipients SET status = ?, error = ?, updated_at = ?
+            WHERE job_id = ? AND user_id = ?
+        ''', [(status, error, updated_at, job_id, user_id) for job_id, user_id, status, error in records])
+        await conn.commit()
+
+async def update_broadcast_checkpoint(job_id, last_user_id):
+    """Запоминает последнего обработанного получателя, с которого продолжится рассылка после перезапуска"""
+    async with get_connection(write=True) as conn:
+        await conn.execute('UPDATE broadcast_jobs SET last_user_id = ? WHERE id = ?', (last_user_id, job_id))
+        await conn.commit()
+
+async def finish_broadcast_job(job_id, status='done'):
+    """Отмечает рассылку завершенной"""
+    finished_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    async with get_connection(write=True) as conn:
+        await conn.execute('UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE id = ?',
+                           (status, finished_at, job_id))
+        await conn.commit()
+
+async def get_broadcast_stats(job_id):
+    """Возвращает количество получателей рассылки по статусам доставки"""
+    async with get_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute('''
+                SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY status
+            ''', (job_id,))
+            rows = await cursor.fetchall()
+            stats = {"sent": 0, "failed": 0, "blocked": 0, "pending": 0}
+            stats.update({row[0]: row[1] for row in rows})
+            return stats
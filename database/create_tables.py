@@ -1,77 +1,202 @@
-from database.database import get_db_connection
+from datetime import datetime
+from database.database import get_connection
 
-async def create_tables():
-    """Создает все необходимые таблицы в базе данных"""
-    conn = await get_db_connection()
-    try:
+# Миграции схемы базы данных. Каждая миграция выполняется один раз,
+# номер последней примененной миграции хранится в таблице schema_version.
+# Новые миграции добавляются только в конец списка MIGRATIONS.
+
+async def create_base_tables(cursor):
+    """Создает основные таблицы: пользователи, сообщения, оценки"""
+    # Таблица пользователей
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            country TEXT,
+            interests TEXT,
+            subject TEXT,
+            onboarding_completed BOOLEAN DEFAULT 0,
+            time_added TEXT
+        )
+    ''')
+    
+    # Таблица сообщений
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            message_text TEXT,
+            response_text TEXT,
+            time_added TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+    
+    # Таблица оценок
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ratings(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER,
+            user_id INTEGER,
+            rating INTEGER,
+            feedback TEXT,
+            time_added TEXT,
+            FOREIGN KEY (message_id) REFERENCES messages(id),
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+async def update_database_schema(cursor):
+    """Добавляет в таблицу users столбцы онбординга, если их нет (базы, созданные до онбординга)"""
+    # Получаем информацию о столбцах таблицы users
+    await cursor.execute("PRAGMA table_info(users)")
+    columns = await cursor.fetchall()
+    column_names = [column[1] for column in columns]
+    
+    # Проверяем и добавляем новые столбцы
+    new_columns = {
+        "country": "TEXT",
+        "interests": "TEXT",
+        "subject": "TEXT",
+        "onboarding_completed": "BOOLEAN DEFAULT 0"
+    }
+    for column_name, column_type in new_columns.items():
+        if column_name not in column_names:
+            print(f"Добавление столбца {column_name} в таблицу users")
+            await cursor.execute(f"ALTER TABLE users ADD COLUMN {column_name} {column_type}")
+
+async def add_indexes(cursor):
+    """Добавляет индексы для выборок по пользователю, времени и сегментам"""
+    # Перед созданием уникального индекса оставляем только последнюю оценку сообщения от пользователя
+    await cursor.execute('''
+        DELETE FROM ratings WHERE id NOT IN (
+            SELECT MAX(id) FROM ratings GROUP BY message_id, user_id
+        )
+    ''')
+    await cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_ratings_message_user ON ratings(message_id, user_id)')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_ratings_user ON ratings(user_id)')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_time ON messages(user_id, time_added)')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_country ON users(country)')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_subject ON users(subject)')
+
+async def create_broadcast_tables(cursor):
+    """Создает таблицы заданий рассылки и журнала доставки по получателям"""
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT,
+            segment_type TEXT,
+            segment_value TEXT,
+            segment_description TEXT,
+            admin_chat_id INTEGER,
+            progress_message_id INTEGER,
+            status TEXT,
+            last_user_id INTEGER DEFAULT 0,
+            created_at TEXT,
+            finished_at TEXT
+        )
+    ''')
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients(
+            job_id INTEGER,
+            user_id INTEGER,
+            status TEXT,
+            error TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (job_id, user_id),
+            FOREIGN KEY (job_id) REFERENCES broadcast_jobs(id)
+        ) WITHOUT ROWID
+    ''')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)')
+
+async def create_fsm_table(cursor):
+    """Создает таблицу для хранения состояний FSM"""
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states(
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at REAL
+        )
+    ''')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)')
+
+async def create_timers_table(cursor):
+    """Создает таблицу отложенных задач планировщика"""
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scheduled_timers(
+            key TEXT PRIMARY KEY,
+            kind TEXT,
+            payload TEXT,
+            due_at REAL
+        )
+    ''')
+
+async def create_session_analysis_table(cursor):
+    """Создает таблицу с отметками о проанализированных диалогах"""
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS session_analysis(
+            user_id INTEGER PRIMARY KEY,
+            analyzed_until TEXT
+        )
+    ''')
+    # Диалоги до появления таблицы уже разобраны прежним анализатором - отмечаем их
+    # проанализированными, чтобы restore_sessions не отправил менеджерам повторные уведомления
+    await cursor.execute('''
+        INSERT OR IGNORE INTO session_analysis (user_id, analyzed_until)
+        SELECT user_id, MAX(time_added) FROM messages GROUP BY user_id
+    ''')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_time ON messages(time_added)')
+
+MIGRATIONS = [
+    (1, "Основные таблицы", create_base_tables),
+    (2, "Столбцы онбординга в users", update_database_schema),
+    (3, "Индексы для сообщений, оценок и сегментов", add_indexes),
+    (4, "Задания рассылок и журнал доставки", create_broadcast_tables),
+    (5, "Хранилище состояний FSM", create_fsm_table),
+    (6, "Отложенные задачи планировщика", create_timers_table),
+    (7, "Отметки анализа диалогов", create_session_analysis_table),
+]
+
+async def apply_migrations():
+    """Применяет к базе данных только еще не примененные миграции"""
+    async with get_connection(write=True) as conn:
         async with conn.cursor() as cursor:
-            # Таблица пользователей
             await cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users(
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER UNIQUE,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    country TEXT,
-                    interests TEXT,
-                    subject TEXT,
-                    onboarding_completed BOOLEAN DEFAULT 0,
-                    time_added TEXT
+                CREATE TABLE IF NOT EXISTS schema_version(
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TEXT
                 )
             ''')
+            await conn.commit()
             
-            # Таблица сообщений
-            await cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages(
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    message_text TEXT,
-                    response_text TEXT,
-                    time_added TEXT,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            ''')
+            await cursor.execute('SELECT MAX(version) FROM schema_version')
+            result = await cursor.fetchone()
+            current_version = result[0] if result and result[0] else 0
             
-            # Таблица оценок
-            await cursor.execute('''
-                CREATE TABLE IF NOT EXISTS ratings(
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    message_id INTEGER,
-                    user_id INTEGER,
-                    rating INTEGER,
-                    feedback TEXT,
-                    time_added TEXT,
-                    FOREIGN KEY (message_id) REFERENCES messages(id),
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            ''')
-                        # Таблица сессий диалогов
-    finally:
-        await conn.close()
+            for version, description, migration in MIGRATIONS:
+                if version <= current_version:
+                    continue
+                
+                print(f"Применение миграции {version}: {description}")
+                # Каждая миграция выполняется в отдельной транзакции вместе с записью ее номера
+                await cursor.execute('BEGIN')
+                try:
+                    await migration(cursor)
+                    await cursor.execute('''
+                        INSERT INTO schema_version (version, description, applied_at)
+                        VALUES (?, ?, ?)
+                    ''', (version, description, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+                    await conn.commit()
+                except Exception as e:
+                    await conn.rollback()
+                    print(f"Ошибка при применении миграции {version}: {e}")
+                    raise
 
-async def update_database_schema(cursor, conn):
-    """Обновляет схему базы данных, добавляя новые столбцы, если их нет"""
-    try:
-        # Получаем информацию о столбцах таблицы users
-        await cursor.execute("PRAGMA table_info(users)")
-        columns = await cursor.fetchall()
-        column_names = [column[1] for column in columns]
-        
-        # Проверяем и добавляем новые столбцы
-        new_columns = {
-            "country": "TEXT",
-            "interests": "TEXT",
-            "subject": "TEXT",
-            "onboarding_completed": "BOOLEAN DEFAULT 0"
-        }
-        for column_name, column_type in new_columns.items():
-            if column_name not in column_names:
-                print(f"Добавление столбца {column_name} в таблицу users")
-                await cursor.execute(f"ALTER TABLE users ADD COLUMN {column_name} {column_type}")
-        
-        await conn.commit()
-        print("Схема базы данных успешно обновлена")
-    except Exception as e:
-        print(f"Ошибка при обновлении схемы базы данных: {e}")
-        raise
+async def create_tables():
+    """Создает все необходимые таблицы в базе данных и применяет миграции"""
+    await apply_migrations()
@@ -1,7 +1,105 @@
-import aiosqlite 
-import os     
+import asyncio
+import os
+from contextlib import asynccontextmanager
 
-async def get_db_connection():
-    db_path = os.path.join(os.path.dirname(__file__), 'database_cf.db')
-    conn = await aiosqlite.connect(db_path)
-    return conn
\ No newline at end of file
+import aiosqlite
+
+from config.settings import settings
+
+DB_PATH = os.path.join(os.path.dirname(__file__), 'database_cf.db')
+
+
+class ConnectionPool:
+    """
+    Пул долгоживущих соединений с SQLite в режиме WAL.
+    
+    Запись идет через одно соединение под блокировкой (SQLite допускает только
+    одного писателя), чтение - через несколько соединений параллельно с записью.
+    """
+    
+    def __init__(self, db_path, readers):
+        self.db_path = db_path
+        self.readers_count = readers
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = None
+        self._all_readers = []
+        self._open_lock = asyncio.Lock()
+    
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.db_path, timeout=settings.DB_BUSY_TIMEOUT_MS / 1000)
+        await conn.execute('PRAGMA journal_mode=WAL')
+        await conn.execute('PRAGMA synchronous=NORMAL')
+        await conn.execute(f'PRAGMA cache_size=-{settings.DB_CACHE_SIZE_KB}')
+        await conn.execute(f'PRAGMA busy_timeout={settings.DB_BUSY_TIMEOUT_MS}')
+        await conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+    
+    async def open(self):
+        """Открывает соединения пула (повторный вызов ничего не делает)"""
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            self._writer = await self._connect()
+            self._readers = asyncio.Queue()
+            for _ in range(self.readers_count):
+                conn = await self._connect()
+                self._all_readers.append(conn)
+                self._readers.put_nowait(conn)
+    
+    async def close(self):
+        """Закрывает все соединения пула"""
+        async with self._open_lock:
+            if self._writer is None:
+                return
+            for conn in self._all_readers:
+                await conn.close()
+            await self._writer.close()
+            self._writer = None
+            self._readers = None
+            self._all_readers = []
+    
+    @asynccontextmanager
+    async def connection(self, write=False):
+        """
+        Выдает соединение из пула.
+        
+        Args:
+            write (bool): Нужно ли соединение для записи. Изменения, не
+                зафиксированные через commit, откатываются при ошибке.
+        """
+        if self._writer is None:
+            await self.open()
+        
+        if write:
+            async with self._write_lock:
+                try:
+                    yield self._writer
+                except BaseException:
+                    await self._writer.rollback()
+                    raise
+            return
+        
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+
+pool = ConnectionPool(DB_PATH, settings.DB_READ_POOL_SIZE)
+
+
+async def init_db():
+    """Открывает пул соединений при запуске бота"""
+    await pool.open()
+
+
+async def close_db():
+    """Закрывает пул соединений при остановке бота"""
+    await pool.close()
+
+
+def get_connection(write=False):
+    """Асинхронный контекстный менеджер для получения соединения из пула"""
+    return pool.connection(write)
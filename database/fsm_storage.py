@@ -0,0 +1,112 @@
+import json
+import time
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+from config.settings import settings
+from database.database import get_connection
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в базе SQLite.
+    
+    Состояния переживают перезапуск бота. Недавно использованные записи
+    держатся в LRU-кэше в памяти (запись идет сразу и в кэш, и в базу),
+    состояния, не менявшиеся дольше settings.FSM_STATE_TTL, удаляются.
+    """
+    
+    def __init__(self, ttl=None, cache_size=None):
+        self.ttl = ttl or settings.FSM_STATE_TTL
+        self.cache_size = cache_size or settings.FSM_CACHE_SIZE
+        self._cache = OrderedDict()  # ключ -> [state, data, updated_at]
+        self._last_purge = time.time()
+    
+    @staticmethod
+    def _make_key(key):
+        return ':'.join(str(part) if part is not None else '' for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            getattr(key, 'business_connection_id', None), key.destiny
+        ))
+    
+    async def _load(self, storage_key):
+        key = self._make_key(storage_key)
+        now = time.time()
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+        else:
+            async with get_connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute('SELECT state, data, updated_at FROM fsm_states WHERE key = ?', (key,))
+                    row = await cursor.fetchone()
+            # Пока шел запрос, ту же запись мог загрузить другой обработчик - используем его
+            # запись, иначе изменения, сделанные через одну из двух копий, потеряются
+            record = self._cache.get(key)
+            if record is None:
+                record = [row[0], json.loads(row[1]) if row[1] else {}, row[2]] if row else [None, {}, now]
+            self._remember(key, record)
+        
+        # Устаревшее состояние считаем пустым
+        if now - record[2] > self.ttl:
+            record[0], record[1] = None, {}
+        return key, record
+    
+    def _remember(self, key, record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+    
+    async def _save(self, key, record):
+        record[2] = time.time()
+        async with get_connection(write=True) as conn:
+            if record[0] is None and not record[1]:
+                # Пустые записи не храним
+                await conn.execute('DELETE FROM fsm_states WHERE key = ?', (key,))
+            else:
+                await conn.execute('''
+                    INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET
+                        state = excluded.state,
+                        data = excluded.data,
+                        updated_at = excluded.updated_at
+                ''', (key, record[0], json.dumps(record[1], ensure_ascii=False), record[2]))
+            await conn.commit()
+        
+        if record[2] - self._last_purge > settings.FSM_PURGE_INTERVAL:
+            await self.purge_expired()
+    
+    async def purge_expired(self):
+        """Удаляет из базы и кэша состояния, которые не менялись дольше TTL"""
+        now = time.time()
+        self._last_purge = now
+        for key in [key for key, record in self._cache.items() if now - record[2] > self.ttl]:
+            del self._cache[key]
+        async with get_connection(write=True) as conn:
+            await conn.execute('DELETE FROM fsm_states WHERE updated_at < ?', (now - self.ttl,))
+            await conn.commit()
+    
+    async def set_state(self, key, state=None):
+        key, record = await self._load(key)
+        record[0] = state.state if isinstance(state, State) else state
+        await self._save(key, record)
+    
+    async def get_state(self, key):
+        _, record = await self._load(key)
+        return record[0]
+    
+    async def set_data(self, key, data):
+        key, record = await self._load(key)
+        record[1] = dict(data)
+        await self._save(key, record)
+    
+    async def get_data(self, key):
+        _, record = await self._load(key)
+        return dict(record[1])
+    
+    async def close(self):
+        # Соединения с базой закрываются вместе с пулом в bot.py
+        self._cache.clear()
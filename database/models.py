@@ -1,25 +1,22 @@
 from datetime import datetime
-from database.database import get_db_connection
+from database.database import get_connection
+from database.write_queue import BatchWriter
 
 # Функции для работы с пользователями
 async def add_user(user_id, username, first_name, last_name):
     """Добавляет нового пользователя в базу данных"""
     time_added = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    conn = await get_db_connection()
-    try:
+    async with get_connection(write=True) as conn:
         async with conn.cursor() as cursor:
             await cursor.execute('''
                 INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, time_added)
                 VALUES (?, ?, ?, ?, ?)
             ''', (user_id, username, first_name, last_name, time_added))
             await conn.commit()
-    finally:
-        await conn.close()
 
 async def get_user(user_id):
     """Получает информацию о пользователе по его ID"""
-    conn = await get_db_connection()
-    try:
+    async with get_connection() as conn:
         async with conn.cursor() as cursor:
             # Явно указываем порядок полей
             await cursor.execute('''
@@ -28,73 +25,138 @@ async def get_user(user_id):
                 FROM users WHERE user_id = ?
             ''', (user_id,))
             return await cursor.fetchone()
-    finally:
-        await conn.close()
 
 
 # Функции для работы с сообщениями
-async def add_message(user_id, message_text, response_text):
-    """Добавляет новое сообщение в базу данных и возвращает его ID"""
-    time_added = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    conn = await get_db_connection()
-    try:
-        async with conn.cursor() as cursor:
-            await cursor.execute('''
+async def add_messages(messages):
+    """
+    Добавляет несколько сообщений одной транзакцией.
+    
+    Args:
+        messages (list): Кортежи (user_id, message_text, response_text, time_added)
+    
+    Returns:
+        list: ID добавленных сообщений в том же порядке
+    """
+    message_ids = []
+    async with get_connection(write=True) as conn:
+        for record in messages:
+            cursor = await conn.execute('''
                 INSERT INTO messages (user_id, message_text, response_text, time_added)
                 VALUES (?, ?, ?, ?)
-            ''', (user_id, message_text, response_text, time_added))
-            await conn.commit()
-            
-            # Получаем ID последней вставленной записи
-            await cursor.execute('SELECT last_insert_rowid()')
-            result = await cursor.fetchone()
-            return result[0] if result else None
-    finally:
-        await conn.close()
+            ''', record)
+            message_ids.append(cursor.lastrowid)
+        await conn.commit()
+    return message_ids
 
-# Функции для работы с оценками
-async def add_rating(message_id, user_id, rating, feedback=None):
-    """Добавляет или обновляет оценку сообщения"""
-    time_added = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    print(f"Вызов add_rating: message_id={message_id}, user_id={user_id}, rating={rating}, feedback={feedback}")
+async def get_messages_since(user_id, since):
+    """Возвращает сообщения пользователя начиная с момента since ('%Y-%m-%d %H:%M:%S') по порядку"""
+    async with get_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute('''
+                SELECT message_text, response_text, time_added FROM messages
+                WHERE user_id = ? AND time_added >= ?
+                ORDER BY time_added, id
+            ''', (user_id, since))
+            return await cursor.fetchall()
+
+async def get_recent_messages(user_id, since, limit):
+    """
+    Возвращает последние сообщения пользователя начиная с момента since.
     
-    conn = await get_db_connection()
-    try:
+    Returns:
+        list: Кортежи (message_text, response_text) от старых к новым
+    """
+    async with get_connection() as conn:
         async with conn.cursor() as cursor:
-            # Проверяем, существует ли уже оценка для этого сообщения
             await cursor.execute('''
-                SELECT id FROM ratings WHERE message_id = ? AND user_id = ?
-            ''', (message_id, user_id))
-            
-            existing_rating = await cursor.fetchone()
-            
-            if existing_rating:
-                # Обновляем существующую оценку
-                print(f"Обновляем существующую оценку с id={existing_rating[0]}")
-                await cursor.execute('''
-                    UPDATE ratings 
-                    SET rating = ?, feedback = ?, time_added = ?
-                    WHERE id = ?
-                ''', (rating, feedback, time_added, existing_rating[0]))
-            else:
-                # Добавляем новую оценку
-                print(f"Добавляем новую оценку")
-                await cursor.execute('''
-                    INSERT INTO ratings (message_id, user_id, rating, feedback, time_added)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (message_id, user_id, rating, feedback, time_added))
-            
-            await conn.commit()
-            print("Транзакция успешно завершена")
-    except Exception as e:
-        print(f"Ошибка в add_rating: {e}")
-        raise
-    finally:
-        await conn.close()
+                SELECT message_text, response_text FROM messages
+                WHERE user_id = ? AND time_added >= ?
+                ORDER BY time_added DESC, id DESC
+                LIMIT ?
+            ''', (user_id, since, limit))
+            rows = await cursor.fetchall()
+            return [tuple(row) for row in reversed(rows)]
+
+# Функции для работы с сессиями анализа диалогов
+async def get_unanalyzed_sessions(since):
+    """
+    Возвращает сводку по непроанализированным сообщениям пользователей начиная с момента since.
+    
+    Returns:
+        list: Кортежи (user_id, время первого сообщения, время последнего сообщения, количество)
+    """
+    async with get_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute('''
+                SELECT m.user_id, MIN(m.time_added), MAX(m.time_added), COUNT(*)
+                FROM messages m
+                LEFT JOIN session_analysis a ON a.user_id = m.user_id
+                WHERE m.time_added >= ? AND m.time_added > COALESCE(a.analyzed_until, '')
+                GROUP BY m.user_id
+            ''', (since,))
+            return await cursor.fetchall()
+
+async def mark_session_analyzed(user_id, analyzed_until):
+    """Запоминает, что сообщения пользователя до момента analyzed_until проанализированы"""
+    async with get_connection(write=True) as conn:
+        await conn.execute('''
+            INSERT INTO session_analysis (user_id, analyzed_until) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET analyzed_until = MAX(analyzed_until, excluded.analyzed_until)
+        ''', (user_id, analyzed_until))
+        await conn.commit()
+
+# Очередь фоновой записи сообщений
+message_writer = BatchWriter('messages', add_messages)
+
+def enqueue_message(user_id, message_text, response_text, time_added=None):
+    """
+    Ставит сообщение в очередь на запись, не дожидаясь сохранения в базе.
+    
+    Args:
+        time_added (str): Время сообщения ('%Y-%m-%d %H:%M:%S'), по умолчанию - текущее
+    
+    Returns:
+        asyncio.Future: ID сообщения после сохранения
+    """
+    time_added = time_added or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return message_writer.submit((user_id, message_text, response_text, time_added))
+
+# Функции для работы с оценками
+# Уникальный индекс ratings(message_id, user_id) позволяет сохранить оценку одним запросом
+RATING_UPSERT_QUERY = '''
+    INSERT INTO ratings (message_id, user_id, rating, feedback, time_added)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(message_id, user_id) DO UPDATE SET
+        rating = excluded.rating,
+        feedback = excluded.feedback,
+        time_added = excluded.time_added
+'''
+
+async def add_ratings(ratings):
+    """
+    Добавляет или обновляет несколько оценок одной транзакцией.
+    
+    Args:
+        ratings (list): Кортежи (message_id, user_id, rating, feedback)
+    """
+    time_added = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    async with get_connection(write=True) as conn:
+        await conn.executemany(RATING_UPSERT_QUERY, [
+            (message_id, user_id, rating, feedback, time_added)
+            for message_id, user_id, rating, feedback in ratings
+        ])
+        await conn.commit()
+
+# Очередь фоновой записи оценок
+rating_writer = BatchWriter('ratings', add_ratings)
+
+def enqueue_rating(message_id, user_id, rating, feedback=None):
+    """Ставит оценку в очередь на запись, не дожидаясь сохранения в базе"""
+    return rating_writer.submit((message_id, user_id, rating, feedback))
         
 async def update_user_onboarding(user_id, country=None, interests=None,subject=None, completed=False):
-    conn = await get_db_connection()
-    try:
+    async with get_connection(write=True) as conn:
         async with conn.cursor() as cursor:
             # Формируем части запроса в зависимости от переданных параметров
             update_parts = []
@@ -122,24 +184,18 @@ async def update_user_onboarding(user_id, country=None, interests=None,subject=N
                 await conn.commit()
                 return True
             return False
-    finally:
-        await conn.close()
         
 async def get_user_onboarding_status(user_id):
     # Проверяет, что пользователь завершил онбординг
-    conn = await get_db_connection()
-    try:
+    async with get_connection() as conn:
         async with conn.cursor() as cursor:
             await cursor.execute('SELECT onboarding_completed FROM users WHERE user_id = ?', (user_id,))
             result = await cursor.fetchone()
             return result[0] if result else False
-    finally:
-        await conn.close()
 
 async def update_user_onboarding(user_id, country=None, interests=None, subject=None, completed=False):
     """Обновляет информацию о пользователе после онбординга"""
-    conn = await get_db_connection()
-    try:
+    async with get_connection(write=True) as conn:
         async with conn.cursor() as cursor:
             # Формируем части запроса в зависимости от переданных параметров
             update_parts = []
@@ -167,16 +223,11 @@ async def update_user_onboarding(user_id, country=None, interests=None, subject=
                 await conn.commit()
                 return True
             return False
-    finally:
-        await conn.close()
 
 async def get_user_onboarding_status(user_id):
     """Проверяет, завершил ли пользователь онбординг"""
-    conn = await get_db_connection()
-    try:
+    async with get_connection() as conn:
         async with conn.cursor() as cursor:
             await cursor.execute('SELECT onboarding_completed FROM users WHERE user_id = ?', (user_id,))
             result = await cursor.fetchone()
             return bool(result[0]) if result else False
-    finally:
-        await conn.close()
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """
+    Фоновая запись в базу данных пачками.
+    
+    Записи принимаются через очередь и сохраняются одной транзакцией, когда
+    набирается max_batch записей или проходит max_delay секунд с первой
+    записи пачки. Для каждой записи возвращается future с результатом функции
+    сохранения (например, ID новой строки).
+    """
+    
+    def __init__(self, name, flush_fn, max_batch=100, max_delay=0.05):
+        self.name = name
+        self.flush_fn = flush_fn  # async fn(list записей) -> list результатов или None
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = None
+        self._task = None
+    
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            if self._queue is None:
+                self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+    
+    def submit(self, item):
+        """
+        Ставит запись в очередь.
+        
+        Returns:
+            asyncio.Future: Результат сохранения записи
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future))
+        return future
+    
+    async def _collect_batch(self):
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+    
+    async def _flush(self, batch):
+        try:
+            results = await self.flush_fn([item for item, _ in batch])
+        except Exception as e:
+            logger.error(f"Ошибка при пакетной записи ({self.name}): {e}", exc_info=True)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+                    # Ошибку уже записали в лог, чтобы не было предупреждений о необработанных исключениях
+                    future.exception()
+            return
+        
+        results = results or [None] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+    
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            await self._flush(batch)
+            for _ in batch:
+                self._queue.task_done()
+    
+    async def flush(self):
+        """Дожидается сохранения всех поставленных в очередь записей"""
+        if self._queue is not None and self._task is not None and not self._task.done():
+            await self._queue.join()
+    
+    async def stop(self):
+        """Сохраняет оставшиеся записи и останавливает фоновую задачу"""
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
@@ -7,9 +7,12 @@ from aiogram.fsm.state import State, StatesGroup
 from config.settings import settings
 from keyboards.admin_kb import get_admin_main_keyboard, get_admin_back_keyboard, get_broadcast_confirmation_keyboard 
 from keyboards.admin_kb import get_segment_keyboard, get_segment_selection_keyboard
-from database.admin_models import get_users_count, get_messages_count, get_ratings_stats, get_all_users, get_all_user_ids 
-from database.admin_models import get_available_segments, get_users_by_segment, delete_user
+from database.admin_models import get_users_count, get_messages_count, get_ratings_stats, get_all_users
+from database.admin_models import get_available_segments, count_users_in_segment, delete_user
 from aiogram.types import Chat
+from handlers.common import ai_service, user_lanes
+from database.broadcast_models import create_broadcast_job
+from services.broadcaster import start_broadcast_job
 
 def is_admin_filter(message):
     return is_admin(message.from_user.id)
@@ -69,6 +72,19 @@ async def admin_statistics(message: Message, state: FSMContext):
             stars = "⭐" * rating
             stats_text += f"{stars}: {count}\n"
     
+    # Добавляем статистику кэшей AI-сервиса
+    cache_stats = ai_service.cache_stats()
+    stats_text += "\n<b>Кэш AI-сервиса:</b>\n"
+    stats_text += f"🧠 Эмбеддинги: {cache_stats['embedding_hits']} попаданий / {cache_stats['embedding_misses']} промахов\n"
+    stats_text += f"💡 Ответы: {cache_stats['answer_hits']} попаданий / {cache_stats['answer_misses']} промахов\n"
+    stats_text += f"🗂 Диалоги в памяти: {cache_stats['memory_users']} пользователей, {cache_stats['memory_turns']} сообщений\n"
+    stats_text += f"🔗 Объединено одинаковых вопросов: {cache_stats['coalesced_requests']}\n"
+    stats_text += f"🚦 Запросы к модели: {cache_stats['llm_active']} выполняется, {cache_stats['llm_waiting']} в очереди, {cache_stats['llm_rejected']} отклонено\n"
+    lane_stats = user_lanes.stats()
+    stats_text += f"✉️ Объединено сообщений подряд: {lane_stats['merged']}, отменено устаревших ответов: {lane_stats['superseded']}\n"
+    token_usage = ai_service.token_usage
+    stats_text += f"🔢 Токены: {token_usage['prompt_tokens']} в промптах / {token_usage['completion_tokens']} в ответах за {token_usage['requests']} запросов\n"
+    
     await message.answer(stats_text, parse_mode="HTML")
     
 
@@ -306,59 +322,35 @@ async def admin_broadcast_confirm(callback: CallbackQuery, state: FSMContext):
     segment_type = data.get('segment_type')
     segment_value = data.get('segment_value')
     
-    # Получаем список пользователей в зависимости от выбранного сегмента
-    if segment_type:
-        if segment_type == "country":
-            user_ids = await get_users_by_segment(country=segment_value)
-            segment_description = f"из страны {segment_value}"
-        elif segment_type == "interests":
-            user_ids = await get_users_by_segment(interests=segment_value)
-            segment_description = f"интересующихся темой {segment_value}"
-        elif segment_type == "subject":
-            user_ids = await get_users_by_segment(subject=segment_value)
-            segment_description = f"преподающих предмет {segment_value}"
-        else:
-            user_ids = await get_all_user_ids()
-            segment_description = "всем пользователям"
+    # Описание сегмента для сообщений о ходе рассылки
+    if segment_type == "country":
+        segment_description = f"из страны {segment_value}"
+    elif segment_type == "interests":
+        segment_description = f"интересующихся темой {segment_value}"
+    elif segment_type == "subject":
+        segment_description = f"преподающих предмет {segment_value}"
     else:
-        user_ids = await get_all_user_ids()
+        segment_type, segment_value = None, None
         segment_description = "всем пользователям"
     
+    users_count = await count_users_in_segment(segment_type, segment_value)
+    
     # Отправляем сообщение о начале рассылки
     await callback.message.edit_text(
-        f"Начинаю рассылку сообщения {len(user_ids)} пользователям {segment_description}...",
+        f"Начинаю рассылку сообщения {users_count} пользователям {segment_description}...",
         reply_markup=None
     )
     
-    # Счетчики успешных отправок
-    success_count = 0
-    error_count = 0
-    
-    # Отправляем сообщения пользователям
-    for user_id in user_ids:
-        try:
-            await callback.bot.send_message(
-                chat_id=user_id,
-                text=broadcast_text,
-                parse_mode="HTML"
-            )
-            success_count += 1
-        except Exception as e:
-            print(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
-            error_count += 1
-    
-    # Отправляем сообщение об окончании рассылки
-    await callback.message.answer(
-        f"✅ Рассылка завершена!\n\n"
-        f"📊 <b>Статистика:</b>\n"
-        f"✓ Успешно отправлено: {success_count}\n"
-        f"✗ Ошибок: {error_count}",
-        parse_mode="HTML"
-    )
+    # Рассылка сохраняется в базе и идет в фоне, админ может продолжать работу с панелью.
+    # Если бот перезапустится, рассылка продолжится с места остановки.
+    job_id = await create_broadcast_job(broadcast_text, segment_type, segment_value, segment_description,
+                                        callback.message.chat.id, callback.message.message_id)
+    start_broadcast_job(callback.bot, job_id)
     
     # Возвращаемся в главное меню
     await state.set_state(AdminStates.main_menu)
     await callback.message.answer(
+        "Рассылка запущена в фоне, о завершении придет отдельное сообщение.\n"
         "Вы вернулись в главное меню админ-панели.",
         reply_markup=get_admin_main_keyboard()
     )
@@ -1,23 +1,117 @@
+import time
+import asyncio
 from datetime import datetime
 from aiogram.types import Message
 from aiogram import Router, F, Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from services.ai_service import AIService
-from database.models import add_user, add_message, get_user_onboarding_status
+from services.admission import Overloaded
+from database.models import add_user, enqueue_message, get_user_onboarding_status
 from handlers.rating import register_user_activity, start_new_session, RatingStates
 from handlers.onboarding import start_onboarding
 from config.settings import settings
 from services.session_analyzer import add_message_to_session
+from services.user_lanes import UserLanes
 
 common_router = Router()
 
 ai_service = AIService()
+# Сообщения каждого пользователя обрабатываются по очереди, быстрые серии объединяются
+user_lanes = UserLanes(settings.MESSAGE_DEBOUNCE)
+
+# Максимальная длина сообщения в Telegram
+MESSAGE_LIMIT = 4096
 
 # Функция для проверки, является ли чат группой менеджеров
 def is_manager_group(message: Message) -> bool:
     return message.chat.id == settings.MANAGER_CHAT_ID and message.chat.type != 'private'
 
+async def edit_answer(bot_message: Message, text: str) -> float:
+    """
+    Редактирует сообщение с ответом.
+    
+    Returns:
+        float: 0, если сообщение отредактировано, иначе - сколько секунд Telegram просит подождать
+    """
+    try:
+        await bot_message.edit_text(text)
+    except TelegramRetryAfter as e:
+        return float(e.retry_after)
+    except TelegramBadRequest as e:
+        # Текст не изменился с прошлого редактирования - это не ошибка
+        if 'message is not modified' not in str(e):
+            raise
+    return 0.0
+
+async def send_streaming_answer(message: Message, chunks):
+    """
+    Отправляет ответ по мере генерации, редактируя одно сообщение не чаще
+    settings.STREAM_EDIT_INTERVAL секунд, чтобы не упираться в лимиты Telegram.
+    
+    Args:
+        message (Message): Сообщение пользователя
+        chunks: Асинхронный генератор фрагментов ответа
+    
+    Returns:
+        tuple: (полный текст ответа, отправленное сообщение бота или None,
+               если не пришло ни одного фрагмента)
+    """
+    answer = ""
+    bot_message = None
+    next_edit = 0.0
+    
+    try:
+        async for chunk in chunks:
+            answer += chunk
+            now = time.monotonic()
+            if bot_message is None:
+                # Первое сообщение отправляем сразу, как только пришел первый фрагмент
+                bot_message = await message.answer(answer[:MESSAGE_LIMIT])
+                next_edit = now + settings.STREAM_EDIT_INTERVAL
+            elif now >= next_edit and len(answer) <= MESSAGE_LIMIT:
+                retry_after = await edit_answer(bot_message, answer)
+                if retry_after:
+                    # Telegram ограничил частоту, откладываем следующее редактирование
+                    next_edit = now + max(retry_after, settings.STREAM_EDIT_INTERVAL * 3)
+                    continue
+                next_edit = now + settings.STREAM_EDIT_INTERVAL
+    except asyncio.CancelledError:
+        # Ответ отменен новым сообщением пользователя - убираем недописанный текст
+        if bot_message is not None:
+            try:
+                await bot_message.delete()
+            except Exception as e:
+                print(f"Ошибка при удалении отмененного ответа: {e}")
+        raise
+    return answer, bot_message
+
+async def finish_streaming_answer(message: Message, answer: str, bot_message):
+    """
+    Выводит окончательный текст ответа, отправленного send_streaming_answer.
+    
+    Returns:
+        Message: Последнее отправленное сообщение бота
+    """
+    if bot_message is None:
+        return await message.answer(answer or "Не удалось получить ответ.")
+    
+    # Финальный текст: первая часть в уже отправленном сообщении, остальное - новыми сообщениями
+    parts = [answer[i:i + MESSAGE_LIMIT] for i in range(0, len(answer), MESSAGE_LIMIT)]
+    for attempt in range(1, settings.STREAM_FINAL_EDIT_RETRIES + 1):
+        retry_after = await edit_answer(bot_message, parts[0])
+        if not retry_after:
+            break
+        if attempt < settings.STREAM_FINAL_EDIT_RETRIES:
+            await asyncio.sleep(retry_after)
+    else:
+        # Отредактировать так и не удалось - отправляем полный текст новым сообщением
+        bot_message = await message.answer(parts[0])
+    for part in parts[1:]:
+        bot_message = await message.answer(part)
+    return bot_message
+
 @common_router.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
     # Игнорируем сообщения из группы менеджеров
@@ -84,29 +178,56 @@ async def cmd_message(message: Message, state: FSMContext):
     # Регистрируем активность пользователя
     register_user_activity(message.chat.id)
     
-    # Используем глобальный экземпляр ai_service вместо создания нового
-    try:
-        # Получаем ответ от AI с передачей user_id
-        answer = await ai_service.get_answer(message.text, user_id=str(message.from_user.id))
+    user_id = message.from_user.id
+    
+    async def generate(query):
+        # Используем глобальный экземпляр ai_service вместо создания нового.
+        # Ответ попадает в историю диалога последним действием генерации, поэтому
+        # отмененная генерация не оставляет в истории недописанного ответа
+        try:
+            if settings.STREAM_ANSWERS:
+                # Отправляем ответ пользователю по мере генерации
+                chunks = ai_service.stream_answer(query, user_id=str(user_id))
+                return await send_streaming_answer(message, chunks)
+            # Получаем ответ от AI с передачей user_id
+            return await ai_service.get_answer(query, user_id=str(user_id)), None
+        except Overloaded as e:
+            # Очередь к модели переполнена: отвечаем сразу ответом из кэша или просьбой подождать
+            print(f"Перегрузка, ответ без модели пользователю {user_id}: {e}")
+            return ai_service.fallback_answer(query, str(user_id)), None
+    
+    async def complete(query, result):
+        answer, bot_message = result
+        if answer is None:
+            # Просьбу подождать не сохраняем как ответ и не запрашиваем по ней оценку
+            await message.answer(settings.OVERLOAD_MESSAGE)
+            return
+        if settings.STREAM_ANSWERS:
+            await finish_streaming_answer(message, answer, bot_message)
+        else:
+            # Отправляем ответ пользователю
+            await message.answer(answer)
         
-        # Сохраняем сообщение и ответ в базу данных
+        # Сохраняем сообщение и ответ в базу данных через фоновую очередь записи
+        time_added = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         try:
-            message_id = await add_message(message.from_user.id, message.text, answer)
+            message_id = await enqueue_message(user_id, query, answer, time_added)
         except Exception as e:
             print(f"Ошибка при сохранении сообщения: {e}")
             message_id = None
         
-        # Отправляем ответ пользователю
-        bot_message = await message.answer(answer)
-        
-        # Добавляем сообщение в сессию для анализа
-        await add_message_to_session(message.from_user.id, message.text, answer)
+        # Добавляем сообщение в сессию для анализа: сессия начинается со времени записи сообщения
+        await add_message_to_session(user_id, query, answer, time_added)
         
         # Начинаем новую сессию для оценки
         if message_id:
             # Получаем бот из контекста сообщения
             bot = message.bot
             await start_new_session(message.chat.id, message_id, bot)
-        
+    
+    try:
+        # Несколько сообщений подряд объединяются в один вопрос, а ответ на
+        # предыдущие сообщения отменяется, если он еще генерируется
+        await user_lanes.run(user_id, message.text, generate, complete)
     except Exception as e:
         await message.answer(f"Произошла ошибка при обработке вашего запроса: {str(e)}")
@@ -1,4 +1,3 @@
-import asyncio
 from datetime import datetime
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
@@ -6,8 +5,9 @@ from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from keyboards.rating_kb_inline import get_rating_keyboard, get_feedback_keyboard
-from database.models import add_rating
+from database.models import enqueue_rating
 from config.settings import settings
+from services.scheduler import scheduler
 
 # Создаем роутер для обработки оценок
 rating_router = Router()
@@ -27,49 +27,83 @@ def is_manager_group(message_or_callback):
     
     return chat.id == settings.MANAGER_CHAT_ID and chat.type != 'private'
 
-# Словарь для хранения активных сессий и таймеров
+# Словарь для хранения активных сессий оценки.
+# Записи удаляются по таймеру планировщика, поэтому словарь не растет бесконечно.
 active_sessions = {}
 
-async def start_rating_timer(chat_id, message_id, bot):
+def end_session(chat_id):
     """
-    Запускает таймер для отправки запроса на оценку через 3 минуты.
+    Завершает сессию оценки и отменяет ее таймеры.
     
     Args:
         chat_id (int): ID чата пользователя
-        message_id (int): ID сообщения, которое нужно оценить
+    """
+    active_sessions.pop(chat_id, None)
+    scheduler.cancel(f"rating_prompt:{chat_id}")
+    scheduler.cancel(f"rating_expire:{chat_id}")
+
+def restore_session(payload):
+    """
+    Восстанавливает сессию оценки из сохраненного таймера после перезапуска бота.
+    
+    Args:
+        payload (dict): Данные таймера с chat_id и message_id
+    """
+    active_sessions.setdefault(payload['chat_id'], {
+        'message_id': payload['message_id'],
+        'last_activity': datetime.now()
+    })
+
+async def send_rating_request(bot, payload):
+    """
+    Отправляет запрос на оценку по таймеру планировщика.
+    
+    Args:
         bot: Экземпляр бота для отправки сообщений
+        payload (dict): Данные таймера с chat_id и message_id
     """
-    # Ждем 3 минуты
-    await asyncio.sleep(180)  # 180 секунд = 3 минуты
+    chat_id = payload['chat_id']
+    message_id = payload['message_id']
     
     # Проверяем, активна ли еще сессия
     if chat_id in active_sessions and active_sessions[chat_id]['message_id'] == message_id:
         # Отправляем запрос на оценку
-        rating_message = await bot.send_message(
-            chat_id=chat_id,
-            text="Пожалуйста, оцените мой ответ от 1 до 5 звезд:",
-            reply_markup=get_rating_keyboard()
-        )
+        try:
+            rating_message = await bot.send_message(
+                chat_id=chat_id,
+                text="Пожалуйста, оцените мой ответ от 1 до 5 звезд:",
+                reply_markup=get_rating_keyboard()
+            )
+        except Exception as e:
+            # Например, пользователь заблокировал бота: таймер истечения не будет запланирован,
+            # поэтому завершаем сессию сразу
+            print(f"Не удалось отправить запрос на оценку пользователю {chat_id}: {e}")
+            end_session(chat_id)
+            return
         
         # Обновляем информацию о сессии
         active_sessions[chat_id]['rating_message_id'] = rating_message.message_id
         
         # Удаляем сессию через 10 минут, если пользователь не оценил
-        asyncio.create_task(clear_session_after_timeout(chat_id, 600))  # 600 секунд = 10 минут
+        scheduler.schedule(f"rating_expire:{chat_id}", 'rating_expire',
+                           settings.RATING_SESSION_TIMEOUT, payload)
 
-async def clear_session_after_timeout(chat_id, timeout):
+async def clear_expired_session(bot, payload):
     """
-    Удаляет сессию после указанного таймаута, если пользователь не ответил.
+    Удаляет сессию по таймауту, если пользователь не ответил.
     
     Args:
-        chat_id (int): ID чата пользователя
-        timeout (int): Время ожидания в секундах
+        bot: Экземпляр бота
+        payload (dict): Данные таймера с chat_id и message_id
     """
-    await asyncio.sleep(timeout)
-    if chat_id in active_sessions:
+    chat_id = payload['chat_id']
+    if chat_id in active_sessions and active_sessions[chat_id]['message_id'] == payload['message_id']:
         del active_sessions[chat_id]
         print(f"Сессия для пользователя {chat_id} удалена по таймауту")
 
+scheduler.register('rating_prompt', send_rating_request, restore=restore_session)
+scheduler.register('rating_expire', clear_expired_session, restore=restore_session)
+
 def register_user_activity(chat_id):
     """
     Регистрирует активность пользователя, сбрасывая таймер оценки.
@@ -90,20 +124,17 @@ async def start_new_session(chat_id, message_id, bot):
         message_id (int): ID сообщения бота
         bot: Экземпляр бота
     """
-    # Если уже есть активная сессия, удаляем её
-    if chat_id in active_sessions:
-        # Отменяем существующие задачи
-        if 'timer_task' in active_sessions[chat_id]:
-            active_sessions[chat_id]['timer_task'].cancel()
-    
-    # Создаем новую сессию
-    timer_task = asyncio.create_task(start_rating_timer(chat_id, message_id, bot))
+    # Если уже есть активная сессия, ее таймеры заменяются новыми
+    scheduler.cancel(f"rating_expire:{chat_id}")
     
     active_sessions[chat_id] = {
         'message_id': message_id,
-        'last_activity': datetime.now(),
-        'timer_task': timer_task
+        'last_activity': datetime.now()
     }
+    
+    # Запрос на оценку отправится через settings.RATING_PROMPT_DELAY секунд
+    scheduler.schedule(f"rating_prompt:{chat_id}", 'rating_prompt', settings.RATING_PROMPT_DELAY,
+                       {'chat_id': chat_id, 'message_id': message_id})
 
 @rating_router.callback_query(F.data.startswith("rate:"))
 async def process_rating(callback: CallbackQuery, state: FSMContext):
@@ -126,8 +157,7 @@ async def process_rating(callback: CallbackQuery, state: FSMContext):
         await callback.message.edit_text("Спасибо! Вы можете оценить ответ позже.")
         
         # Удаляем сессию
-        if callback.message.chat.id in active_sessions:
-            del active_sessions[callback.message.chat.id]
+        end_session(callback.message.chat.id)
         
         return
     
@@ -144,13 +174,9 @@ async def process_rating(callback: CallbackQuery, state: FSMContext):
     # Сохраняем оценку и message_id в состоянии FSM
     await state.update_data(rating=rating, message_id=message_id)
     
-    # Сохраняем оценку в базе данных
+    # Ставим оценку в очередь на запись в базу данных
     if message_id:
-        try:
-            await add_rating(message_id, callback.from_user.id, rating)
-            print(f"Оценка {rating} сохранена для сообщения {message_id}")  # Отладочное сообщение
-        except Exception as e:
-            print(f"Ошибка при сохранении оценки: {e}")
+        enqueue_rating(message_id, callback.from_user.id, rating)
     
     # Благодарим пользователя и предлагаем оставить отзыв для оценок ниже 4
     if rating < 4:
@@ -164,8 +190,7 @@ async def process_rating(callback: CallbackQuery, state: FSMContext):
         )
         
         # Удаляем сессию
-        if chat_id in active_sessions:
-            del active_sessions[chat_id]
+        end_session(chat_id)
     
     # Отвечаем на callback, чтобы убрать часы загрузки
     await callback.answer()
@@ -193,8 +218,7 @@ async def process_feedback_request(callback: CallbackQuery, state: FSMContext):
         await state.clear()
         
         # Удаляем сессию
-        if callback.message.chat.id in active_sessions:
-            del active_sessions[callback.message.chat.id]
+        end_session(callback.message.chat.id)
     else:
         # Пользователь хочет оставить отзыв
         await callback.message.edit_text("Пожалуйста, напишите ваш отзыв в следующем сообщении:")
@@ -243,11 +267,7 @@ async def process_feedback(message: Message, state: FSMContext):
     
     # Обновляем оценку в базе данных, добавляя отзыв
     if message_id:
-        try:
-            await add_rating(message_id, message.from_user.id, rating, feedback_text)
-            print(f"Отзыв сохранен в базе данных для сообщения {message_id}")  # Отладочное сообщение
-        except Exception as e:
-            print(f"Ошибка при сохранении отзыва: {e}")
+        enqueue_rating(message_id, message.from_user.id, rating, feedback_text)
     else:
         print("Не удалось найти ID сообщения для сохранения отзыва")
     
@@ -259,9 +279,8 @@ async def process_feedback(message: Message, state: FSMContext):
     print(f"Состояние сброшено для пользователя {message.from_user.id}")
     
     # Удаляем сессию
-    if chat_id in active_sessions:
-        del active_sessions[chat_id]
-        print(f"Сессия удалена для пользователя {chat_id}")
+    end_session(chat_id)
+    print(f"Сессия удалена для пользователя {chat_id}")
 
 # Команда для принудительного запроса оценки (для тестирования)
 @rating_router.message(Command("rate"))
@@ -0,0 +1,99 @@
+"""
+Оценка качества поиска по базе знаний.
+
+Для каждого вопроса из набора проверяет, попал ли в найденный контекст хотя бы один
+из ожидаемых фрагментов текста, и считает размер контекста в токенах.
+Индекс строится в отдельном каталоге, чтобы не затронуть кэш работающего бота.
+
+Пример запуска из корня проекта:
+    python scripts/eval_retrieval.py --chunking sections --chunk-size 1200 --mode mmr similarity --lexical on off
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config.settings import settings
+from services.prompt_builder import count_tokens
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Оценка поиска по базе знаний")
+    parser.add_argument('--questions', default=os.path.join(os.path.dirname(__file__), 'eval_questions.json'),
+                        help="JSON со списком {'question', 'expected': [...]}")
+    parser.add_argument('--chunking', choices=['sections', 'plain'], default=settings.KB_CHUNKING)
+    parser.add_argument('--chunk-size', type=int, default=settings.KB_CHUNK_SIZE)
+    parser.add_argument('--chunk-overlap', type=int, default=settings.KB_CHUNK_OVERLAP)
+    parser.add_argument('--mode', nargs='+', choices=['mmr', 'similarity'], default=[settings.KB_RETRIEVAL_MODE])
+    parser.add_argument('--lexical', nargs='+', choices=['on', 'off'],
+                        default=['on' if settings.KB_LEXICAL_ENABLED else 'off'],
+                        help="Гибридный поиск с BM25 (on) или только FAISS (off)")
+    parser.add_argument('--k', type=int, default=settings.KB_RETRIEVAL_K)
+    parser.add_argument('--max-distance', type=float, default=settings.KB_MAX_DISTANCE)
+    parser.add_argument('--index-dir', default='base/index_cache_eval')
+    parser.add_argument('--verbose', action='store_true', help="Печатать результат по каждому вопросу")
+    return parser.parse_args()
+
+
+async def evaluate(service, questions, k, verbose=False):
+    """
+    Returns:
+        dict: {'recall': доля вопросов с найденным ожидаемым фрагментом,
+               'avg_tokens': средний размер контекста в токенах, 'avg_chunks': среднее число отрезков}
+    """
+    hits = 0
+    total_tokens = 0
+    total_chunks = 0
+    for item in questions:
+        docs = await service.search(item['question'], k)
+        context = "\n".join(service.chunk_text(doc) for doc in docs)
+        hit = any(expected.lower() in context.lower() for expected in item['expected'])
+        tokens = count_tokens(context)
+        hits += hit
+        total_tokens += tokens
+        total_chunks += len(docs)
+        if verbose:
+            sections = ', '.join(doc.metadata.get('section', '') for doc in docs)
+            print(f"{'+' if hit else '-'} {item['question']} ({tokens} токенов): {sections}")
+    count = len(questions) or 1
+    return {
+        'recall': hits / count,
+        'avg_tokens': total_tokens / count,
+        'avg_chunks': total_chunks / count,
+    }
+
+
+async def main():
+    args = parse_args()
+    settings.KB_CHUNKING = args.chunking
+    settings.KB_CHUNK_SIZE = args.chunk_size
+    settings.KB_CHUNK_OVERLAP = args.chunk_overlap
+    settings.KB_MAX_DISTANCE = args.max_distance
+    settings.KB_INDEX_DIR = args.index_dir
+
+    # Импорт после изменения настроек: индекс строится с параметрами из командной строки
+    from services.ai_service import AIService
+
+    with open(args.questions, 'r', encoding='utf-8') as file:
+        questions = json.load(file)
+
+    service = AIService()
+    print(f"Разбиение: {args.chunking}, размер {args.chunk_size}, перекрытие {args.chunk_overlap}, "
+          f"отрезков в индексе: {service.kb.db.index.ntotal}, вопросов: {len(questions)}")
+    try:
+        for lexical in args.lexical:
+            settings.KB_LEXICAL_ENABLED = lexical == 'on'
+            for mode in args.mode:
+                settings.KB_RETRIEVAL_MODE = mode
+                result = await evaluate(service, questions, args.k, args.verbose)
+                print(f"{mode:<10} BM25 {lexical:<3} k={args.k}: recall {result['recall']:.2f}, "
+                      f"контекст {result['avg_tokens']:.0f} токенов, отрезков {result['avg_chunks']:.1f}")
+    finally:
+        await service.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+class Overloaded(Exception):
+    """Нет свободного места для запроса к модели: очередь заполнена или ожидание истекло"""
+
+
+class AdmissionController:
+    """
+    Ограничение одновременных запросов к модели с очередью ожидания.
+
+    Одновременно выполняется не больше limit запросов. Остальные ждут в очереди
+    не дольше wait_timeout секунд; запросы с приоритетом (пользователи, уже ведущие
+    диалог) получают освободившееся место раньше остальных. Если в очереди уже
+    queue_size запросов, новый запрос сразу получает отказ Overloaded.
+    """
+
+    def __init__(self, limit, queue_size, wait_timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.wait_timeout = wait_timeout
+        self.active = 0
+        self._priority = deque()  # ожидающие с приоритетом
+        self._normal = deque()  # остальные ожидающие
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    @property
+    def waiting(self):
+        return len(self._priority) + len(self._normal)
+
+    async def acquire(self, priority=False):
+        """Занимает место для запроса или выбрасывает Overloaded"""
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            self.admitted += 1
+            return
+        if self.waiting >= self.queue_size:
+            self.rejected += 1
+            raise Overloaded(f"очередь запросов к модели заполнена ({self.waiting})")
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._priority if priority else self._normal
+        queue.append(future)
+        self.queued += 1
+        try:
+            # Освободившееся место передается через future (см. release)
+            await asyncio.wait_for(future, self.wait_timeout)
+        except asyncio.TimeoutError:
+            # Место могло быть передано на том же шаге цикла, на котором истекло ожидание
+            if future.done() and not future.cancelled():
+                self.release()
+            self.timeouts += 1
+            raise Overloaded(f"не дождались очереди к модели за {self.wait_timeout} с")
+        except asyncio.CancelledError:
+            # Место могло быть передано одновременно с отменой - возвращаем его
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            if future in queue:
+                queue.remove(future)
+        self.admitted += 1
+
+    def release(self):
+        """Освобождает место: передает его следующему ожидающему или уменьшает счетчик"""
+        for queue in (self._priority, self._normal):
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority=False):
+        """Контекст, в котором выполняется запрос к модели"""
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+        }
@@ -1,153 +1,549 @@
 import os
-from datetime import datetime
-from openai import AsyncOpenAI
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain.docstore.document import Document
+import json
+import asyncio
+import shutil
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from openai import RateLimitError, APITimeoutError
 from langchain_community.vectorstores import FAISS
 from langchain_openai import OpenAIEmbeddings
 
 from config.settings import settings
+from services.llm_client import create_llm_client
+from services.cache import TTLCache, SemanticAnswerCache, normalize_query
+from services.conversation_memory import ConversationMemory
+from services.prompt_builder import build_prompt, load_encoding
+from services.knowledge_base import KnowledgeBase, build_chunks, build_plain_chunks, content_hash
+from services.lexical_index import BM25Index
+from services.single_flight import SingleFlight
+from services.admission import AdmissionController, Overloaded
+
+logger = logging.getLogger(__name__)
+
+# Ошибки OpenAI, означающие перегрузку API (после повторов клиента): на них, как и на
+# переполненную очередь, пользователь получает быстрый ответ без модели
+API_OVERLOAD_ERRORS = (RateLimitError, APITimeoutError)
+
+# Версия формата кэша индекса, увеличивается при изменении способа построения индекса
+INDEX_CACHE_VERSION = 2
 
 class AIService:
     """Сервис для работы с OpenAI и базой знаний с запоминанием диалогов"""
     
-    def __init__(self):
-        self.base_load()
-        # Инициализация хранилища диалогов
-        self.conversations = {}  # user_id -> список сообщений
+    def __init__(self, client=None):
+        # Токенизатор загружается до начала обработки сообщений, а не в первом ответе
+        load_encoding()
+        # Текущая версия базы знаний; при обновлении файлов заменяется целиком (см. reload_knowledge_base)
+        self.kb = self.base_load()
+        self._kb_mtimes = self._knowledge_base_mtimes()
+        self._reload_lock = asyncio.Lock()
+        # Общий клиент OpenAI, передается из bot.py при запуске
+        self.client = client
+        # Поиск по FAISS выполняется в отдельных потоках, чтобы не блокировать event loop
+        self._executor = ThreadPoolExecutor(max_workers=settings.RETRIEVAL_THREADS,
+                                            thread_name_prefix='faiss')
+        self._retrieval_semaphore = asyncio.Semaphore(settings.RETRIEVAL_MAX_CONCURRENCY)
+        # Кэши эмбеддингов вопросов и готовых ответов на частые вопросы
+        self.embedding_cache = TTLCache(settings.EMBEDDING_CACHE_SIZE, settings.EMBEDDING_CACHE_TTL)
+        self.answer_cache = SemanticAnswerCache(settings.ANSWER_CACHE_SIZE, settings.ANSWER_CACHE_TTL,
+                                                settings.ANSWER_CACHE_THRESHOLD)
+        # Ограниченная память диалогов: последние ходы недавно активных пользователей
+        self.conversations = ConversationMemory(settings.CONVERSATION_HISTORY_TURNS,
+                                                settings.CONVERSATION_MAX_USERS,
+                                                settings.CONVERSATION_IDLE_TTL,
+                                                settings.CONVERSATION_RESTORE_FROM_DB)
+        # Объединение одинаковых одновременных вопросов (например, ответов на рассылку)
+        self.flights = SingleFlight(settings.SINGLE_FLIGHT_TIMEOUT)
+        # Ограничение одновременных запросов к модели с очередью ожидания
+        self.admission = AdmissionController(settings.LLM_MAX_CONCURRENCY, settings.LLM_QUEUE_SIZE,
+                                             settings.LLM_QUEUE_TIMEOUT)
+        # Суммарный расход токенов на ответы
+        self.token_usage = {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
     
-    def base_load(self):
-        """Загрузка базы знаний"""
+    def base_load(self, previous=None):
+        """
+        Загрузка базы знаний и системного промпта.
+        
+        Args:
+            previous (KnowledgeBase): Текущая версия базы; эмбеддинги ее отрезков с неизменным
+                текстом переиспользуются, заново запрашиваются только новые и измененные отрезки
+        
+        Returns:
+            KnowledgeBase: Новая версия базы знаний
+        """
         try:
             # Проверяем наличие директории и создаем ее при необходимости
             os.makedirs('base', exist_ok=True)
             
             # Проверяем наличие файла
-            file_path = 'base/Baza_cf.txt'
+            file_path = settings.KB_FILE_PATH
             
             # читаем текст базы знаний
             with open(file_path, 'r', encoding='utf-8') as file:
                 document = file.read()
-                
-            # создаем список чанков с помощью RecursiveCharacterTextSplitter
-            splitter = RecursiveCharacterTextSplitter(chunk_size=8000, chunk_overlap=200)
-            docs = splitter.create_documents([document])
-            source_chunks = [Document(page_content=chunk.page_content, metadata={}) for chunk in docs]
             
-            # создаем индексную базу
-            embeddings = OpenAIEmbeddings(openai_api_key=settings.OPENAI_API_KEY)
-            self.db = FAISS.from_documents(source_chunks, embeddings)
+            # системный промпт для ответов (со ссылками на курсы) хранится в отдельном файле
+            with open(settings.SYSTEM_PROMPT_PATH, 'r', encoding='utf-8') as file:
+                system = file.read().strip()
             
-            # системный промпт для ответов
-            self.system = '''Ты — AI-продажник Цифрового Педагога, — ведущего образовательного центра для учителей.
-
-Твоя главная задача — конвертировать интерес пользователя в продажу курсов и услуг компании.
-
-Используй следующую структуру в общении:
-1. Определи боль/потребность пользователя
-2. Покажи понимание проблемы и создай эмоциональную связь(Но не нужно каждое предложение начинать со слов понимаю)
-3. Предложи конкретное решение из нашего каталога курсов
-4. Опиши выгоды и результаты от прохождения курса
-5. Создай ощущение срочности (но без давления)
-6. Дай четкий призыв к действию с конкретной ссылкой
-7. При формировании ответа пользователю, помни, что ответ не должен быть слишком большой, не перегружай клиента не нужной информацией, пиши чётко, кратко и по делу
-
-В ответах используй ключевые формулировки, описания и фразы из базы знаний, особенно в блоке выгод, чтобы сохранить точность и убедительность.
-Если в саммари или вопросе не указана явная цель, сначала уточни её, прежде чем рекомендовать курс.
-
-Каждое сообщение начинается с фразы:
-Сообщение составлено AI-ассистентом команды «Цифровой Педагог».
-
-Каждое сообщение должно завершаться призывом к действию и ссылкой на соответствующий курс.
-
-Используй психологические триггеры продаж:
-- Социальное доказательство ("многие учителя уже...")
-- Дефицит ("осталось всего несколько мест")
-- Авторитет ("наши эксперты с опытом...")
-- Взаимность ("получите бесплатный материал прямо сейчас")
-
-Если пользователь интересуется конкретной темой, всегда предлагай соответствующий платный курс, но сначала можешь предложить бесплатный материал для знакомства.
-
-Если клиент колеблется, предложи бесплатный пробный материал, но с акцентом на ограниченность полной информации в бесплатной версии.
-
-Если клиент не знает точно какой курс ему нужен задай ему 1 вопрос, что бы точнее понять его потребности, а потом предложи курс.
-
-Ты работаешь с кратким саммари диалога, актуальным вопросом пользователя и информацией из внутренних документов.
-Используй только эти документы, не выдумывай информацию. Если в саммари указано имя
-пользователя — обязательно обратись по имени и на Вы.
-
-Каждый ответ структурируй, делай абзацы, где это уместно, если что-то перечисляешь делай это списком с маркерами.
-У тебя есть основные ссылки на наши курсы, которые ты должен использовать в своих ответах:
-
-Тебе запрещено придумывать свои ссылки, ты должен использовать только те, что указаны ниже.
-Бесплатные учебные продукты:
-ссылка на Автопрактикум «Онлайн-репетитор с нуля» - https://cp.cifrovoipedagog.online/reg_practicum2
-
-ссылка на гайд Создавай интерактивные уроки в Canva за минуты - https://cifrovoipedagog.getcourse.ru/yrok
-
-Платные учебные продукты:
-ссылка на курс «Цифровой педагог» - cifrovoipedagog.online/cifrovoi-pedagog
-ссылка на Курс «Нейросети - энергия профессионального роста учителя» -  https://cp.cifrovoipedagog.online/neiroseti_kurs
-ссылка на курс «Instagram и блог для репетитора» -  https://cp.cifrovoipedagog.online/Instagram
-ссылка на курс «Доход онлайн для педагога»- https://cp.cifrovoipedagog.online/dohod_kurs
-ссылка на курс «Налоги, реклама и ФСЗН для педагогов» - https://cp.cifrovoipedagog.online/nalogi
-ссылка на Юридический гайд репетитора - https://cp.cifrovoipedagog.online/gaid
-ссылка на курс "Canva учителя: просто, быстро, интерактивно" - https://cifrovoipedagog.getcourse.ru/kurs_canva
-ссылка на МК Виктория Добыш запись "Создавай интерактивные уроки в Canva за минуты" - https://cifrovoipedagog.getcourse.ru/yrok
-Ссылка на МК Татьяна Сыцевич запись "Создай интерактивный рабочий лист в Canva за 1 час": https://cifrovoipedagog.getcourse.ru/mk_canva'''              
+            embeddings = OpenAIEmbeddings(model=settings.EMBEDDING_MODEL, openai_api_key=settings.OPENAI_API_KEY)
+            kb_hash = self._index_cache_key(document)
+            index_path = os.path.join(settings.KB_INDEX_DIR, kb_hash)
+            
+            if os.path.exists(os.path.join(index_path, 'index.faiss')):
+                # Индекс для этой версии базы знаний уже построен, загружаем его с диска
+                db = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
+                logger.info(f"Индекс базы знаний загружен из кэша {index_path}")
+            else:
+                # создаем список чанков: по разделам с метаданными или фиксированного размера
+                if settings.KB_CHUNKING == 'sections':
+                    source_chunks = build_chunks(document, settings.KB_CHUNK_SIZE, settings.KB_CHUNK_OVERLAP)
+                else:
+                    source_chunks = build_plain_chunks(document, settings.KB_CHUNK_SIZE, settings.KB_CHUNK_OVERLAP)
+                
+                # создаем индексную базу, запрашивая эмбеддинги только для новых отрезков
+                db = self._build_index(source_chunks, embeddings, previous)
+                self._save_index(db, index_path, kb_hash)
+                logger.info(f"Индекс базы знаний построен и сохранен в {index_path}")
+            
+            # Лексический индекс строится в памяти по тем же отрезкам, что и FAISS
+            lexical = BM25Index([db.docstore.search(doc_id) for doc_id in db.index_to_docstore_id.values()])
+            return KnowledgeBase(db, lexical, kb_hash, system)
         except Exception as e:
             print(f"Ошибка при загрузке базы знаний: {str(e)}")
             raise
-
-    async def get_answer(self, query: str, user_id: str, k: int = 4) -> str:
-        """Получение ответа на вопрос пользователя с учетом истории диалога"""
+    
+    def _build_index(self, chunks, embeddings, previous=None):
+        """Строит FAISS-индекс, переиспользуя эмбеддинги отрезков предыдущей версии с тем же текстом"""
+        known = previous.vectors_by_hash() if previous else {}
+        texts = [chunk.page_content for chunk in chunks]
+        missing = [text for text in dict.fromkeys(texts) if content_hash(text) not in known]
+        if missing:
+            for text, vector in zip(missing, embeddings.embed_documents(missing)):
+                known[content_hash(text)] = vector
+        logger.info(f"Эмбеддинги отрезков: {len(missing)} запрошено, {len(texts) - len(missing)} переиспользовано")
+        return FAISS.from_embeddings([(text, known[content_hash(text)]) for text in texts], embeddings,
+                                     metadatas=[chunk.metadata for chunk in chunks])
+    
+    def _index_cache_key(self, document):
+        """Ключ кэша индекса: хэш текста базы знаний, параметров разбиения и модели эмбеддингов"""
+        params = {
+            'version': INDEX_CACHE_VERSION,
+            'chunking': settings.KB_CHUNKING,
+            'chunk_size': settings.KB_CHUNK_SIZE,
+            'chunk_overlap': settings.KB_CHUNK_OVERLAP,
+            'embedding_model': settings.EMBEDDING_MODEL,
+        }
+        digest = hashlib.sha256()
+        digest.update(document.encode('utf-8'))
+        digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()[:16]
+    
+    def _save_index(self, db, index_path, kb_hash):
+        """Сохраняет индекс на диск и удаляет устаревшие версии кэша"""
         try:
-            # Получаем историю диалога для пользователя или создаем новую
-            if user_id not in self.conversations:
-                self.conversations[user_id] = []
-            
-            # Получаем релевантные отрезки из базы знаний
-            docs = self.db.similarity_search(query, k=k)
-            context = "\n".join(d.page_content for d in docs)
-            
-            # Формируем историю диалога для контекста
-            conversation_history = ""
-            if self.conversations[user_id]:
-                conversation_history = "История диалога:\n"
-                for msg in self.conversations[user_id][-3:]:  # Берем последние 3 сообщения
-                    conversation_history += f"Пользователь: {msg['user']}\nАссистент: {msg['assistant']}\n"
+            # Сначала пишем во временный каталог, чтобы прерванная запись не оставила битый индекс
+            tmp_path = f"{index_path}.tmp"
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            db.save_local(tmp_path)
+            shutil.rmtree(index_path, ignore_errors=True)
+            os.replace(tmp_path, index_path)
             
-            # Формируем user-промпт с историей диалога
-            user = (
-                "Ответь на вопрос клиента по компании Цифровой Педагог. "
-                f"Контекст: {context}\n"
-                f"{conversation_history}\n"
-                f"Вопрос: {query}"
-            )
-            
-            # Отправляем в OpenAI
-            client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
-            resp = await client.chat.completions.create(
+            for name in os.listdir(settings.KB_INDEX_DIR):
+                if name != kb_hash:
+                    shutil.rmtree(os.path.join(settings.KB_INDEX_DIR, name), ignore_errors=True)
+        except Exception as e:
+            # Ошибка записи кэша не должна мешать работе бота
+            logger.error(f"Не удалось сохранить индекс базы знаний: {e}", exc_info=True)
+    
+    def _knowledge_base_mtimes(self):
+        """Время изменения файлов базы знаний и системного промпта"""
+        mtimes = []
+        for path in (settings.KB_FILE_PATH, settings.SYSTEM_PROMPT_PATH):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+    
+    async def reload_knowledge_base(self):
+        """
+        Перестраивает базу знаний в отдельном потоке и заменяет текущую версию.
+        
+        Запросы продолжают обслуживаться старой версией до замены; при ошибке
+        остается старая версия.
+        
+        Returns:
+            bool: True, если база знаний обновлена
+        """
+        async with self._reload_lock:
+            mtimes = self._knowledge_base_mtimes()
+            try:
+                kb = await asyncio.to_thread(self.base_load, self.kb)
+            except Exception as e:
+                logger.error(f"Не удалось обновить базу знаний, используется прежняя версия: {e}", exc_info=True)
+                return False
+            finally:
+                # Повторная попытка будет только после следующего изменения файлов
+                self._kb_mtimes = mtimes
+            self.kb = kb
+            logger.info(f"База знаний обновлена, версия {kb.version}")
+            return True
+    
+    async def watch_knowledge_base(self):
+        """Проверяет изменения файлов базы знаний раз в settings.KB_RELOAD_INTERVAL секунд"""
+        while True:
+            await asyncio.sleep(settings.KB_RELOAD_INTERVAL)
+            if self._knowledge_base_mtimes() != self._kb_mtimes:
+                logger.info("Файлы базы знаний изменились, перестраиваем индекс")
+                await self.reload_knowledge_base()
+    
+    def set_client(self, client):
+        """Устанавливает общий клиент OpenAI"""
+        self.client = client
+    
+    def _get_client(self):
+        # Если клиент не был передан при запуске, создаем его один раз
+        if self.client is None:
+            self.client = create_llm_client()
+        return self.client
+    
+    async def close(self):
+        """Закрывает клиент OpenAI, если он был создан"""
+        if self.client is not None:
+            await self.client.close()
+    
+    async def embed_query(self, query: str):
+        """Эмбеддинг вопроса с кэшированием повторяющихся запросов"""
+        key = normalize_query(query)
+        embedding = self.embedding_cache.get(key)
+        if embedding is None:
+            # Эмбеддинг запроса получаем через асинхронный клиент
+            response = await self._get_client().embeddings.create(model=settings.EMBEDDING_MODEL, input=query)
+            embedding = response.data[0].embedding
+            self.embedding_cache.set(key, embedding)
+        return embedding
+    
+    def _retrieve(self, kb, embedding, k):
+        """
+        Синхронный поиск по индексу в режиме settings.KB_RETRIEVAL_MODE.
+        
+        Отрезки дальше settings.KB_MAX_DISTANCE отбрасываются (самый близкий остается всегда),
+        результат упорядочен по возрастанию расстояния.
+        """
+        if settings.KB_RETRIEVAL_MODE == 'mmr':
+            docs_and_scores = kb.db.max_marginal_relevance_search_with_score_by_vector(
+                embedding, k=k, fetch_k=max(settings.KB_FETCH_K, k), lambda_mult=settings.KB_MMR_LAMBDA)
+        else:
+            docs_and_scores = kb.db.similarity_search_with_score_by_vector(embedding, k)
+        docs_and_scores = sorted(docs_and_scores, key=lambda item: item[1])
+        if settings.KB_MAX_DISTANCE:
+            docs_and_scores = docs_and_scores[:1] + [item for item in docs_and_scores[1:]
+                                                     if item[1] <= settings.KB_MAX_DISTANCE]
+        return [doc for doc, _ in docs_and_scores]
+    
+    async def search_by_vector(self, embedding, k: int = None, kb=None):
+        """Поиск релевантных отрезков базы знаний по готовому эмбеддингу"""
+        async with self._retrieval_semaphore:
+            # Сам поиск по индексу синхронный, поэтому выносим его в пул потоков
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self._retrieve, kb or self.kb, embedding,
+                                              k or settings.KB_RETRIEVAL_K)
+    
+    def lexical_search(self, query: str, k: int, kb=None):
+        """
+        Поиск по лексическому индексу BM25.
+        
+        Returns:
+            tuple: (отрезки по убыванию оценки, признак уверенного результата)
+        """
+        if not settings.KB_LEXICAL_ENABLED:
+            return [], False
+        kb = kb or self.kb
+        hits, confidence = kb.lexical.search(query, max(settings.KB_FETCH_K, k))
+        docs = [kb.lexical.docs[number] for number, _ in hits]
+        return docs, confidence >= settings.KB_LEXICAL_CONFIDENCE
+    
+    async def embed_query_or_none(self, query: str, lexical_docs):
+        """
+        Эмбеддинг вопроса. Если есть результаты BM25, то при ошибке или долгом ответе
+        API возвращает None, чтобы ответ был построен только по лексическому поиску.
+        """
+        if not lexical_docs:
+            return await self.embed_query(query)
+        try:
+            return await asyncio.wait_for(self.embed_query(query), settings.KB_EMBEDDING_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Эмбеддинг вопроса недоступен ({e!r}), используется только лексический поиск")
+            return None
+    
+    def fuse(self, result_lists, k: int):
+        """Объединяет ранжированные списки отрезков методом reciprocal rank fusion"""
+        scores = {}
+        docs = {}
+        for result in result_lists:
+            for rank, doc in enumerate(result):
+                key = doc.page_content
+                scores[key] = scores.get(key, 0.0) + 1.0 / (settings.KB_RRF_K + rank + 1)
+                docs[key] = doc
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        return [docs[key] for key in ranked[:k]]
+    
+    async def hybrid_search(self, embedding, lexical_docs, k: int, kb=None):
+        """Поиск по FAISS, объединенный с результатами BM25"""
+        vector_docs = await self.search_by_vector(embedding, k, kb)
+        if not lexical_docs:
+            return vector_docs
+        return self.fuse([vector_docs, lexical_docs], k)
+    
+    @staticmethod
+    def chunk_text(doc):
+        """Текст отрезка для промпта со ссылкой на курс из метаданных"""
+        link = doc.metadata.get('link')
+        if link and link not in doc.page_content:
+            return f"{doc.page_content}\nСсылка на курс: {link}"
+        return doc.page_content
+    
+    async def search(self, query: str, k: int = None):
+        """Асинхронный гибридный поиск релевантных отрезков базы знаний"""
+        _, docs, _ = await self._retrieve_context(query, k or settings.KB_RETRIEVAL_K, self.kb)
+        return docs
+    
+    def fallback_answer(self, query: str, user_id: str):
+        """
+        Быстрый ответ без обращения к модели, когда очередь к ней переполнена:
+        ответ на тот же или похожий вопрос из кэша ответов. Близость вопросов
+        проверяется с порогом settings.OVERLOAD_ANSWER_THRESHOLD по эмбеддингу,
+        уже полученному при подготовке запроса.
+        
+        Returns:
+            str: Ответ из кэша (сохраняется в историю диалога) или None
+        """
+        version = self.kb.version
+        answer = self.answer_cache.get_exact(query, version)
+        if answer is None:
+            embedding = self.embedding_cache.get(normalize_query(query))
+            if embedding is not None:
+                answer = self.answer_cache.get(embedding, version, settings.OVERLOAD_ANSWER_THRESHOLD)
+        if answer is not None:
+            self._remember(user_id, query, answer)
+        return answer
+    
+    def _remember(self, user_id, query, answer):
+        """Сохраняет вопрос и ответ в историю диалога"""
+        self.conversations.append(user_id, query, answer)
+    
+    def cache_stats(self):
+        """Статистика кэшей эмбеддингов и ответов и памяти диалогов"""
+        memory_stats = self.conversations.stats()
+        return {
+            'embedding_hits': self.embedding_cache.hits,
+            'embedding_misses': self.embedding_cache.misses,
+            'embedding_size': len(self.embedding_cache),
+            'answer_hits': self.answer_cache.hits,
+            'answer_misses': self.answer_cache.misses,
+            'answer_size': len(self.answer_cache),
+            'memory_users': memory_stats['users'],
+            'memory_turns': memory_stats['turns'],
+            'memory_evictions': memory_stats['evictions'],
+            'memory_restores': memory_stats['restores'],
+            'coalesced_requests': self.flights.followers,
+            'llm_active': self.admission.active,
+            'llm_waiting': self.admission.waiting,
+            'llm_rejected': self.admission.rejected + self.admission.timeouts,
+        }
+    
+    def _record_usage(self, user_id, prompt_usage, usage):
+        """Записывает расход токенов на ответ: оценку при сборке промпта и фактический расход по данным API"""
+        prompt_tokens = usage.prompt_tokens if usage else prompt_usage['prompt_tokens']
+        completion_tokens = usage.completion_tokens if usage else 0
+        self.token_usage['requests'] += 1
+        self.token_usage['prompt_tokens'] += prompt_tokens
+        self.token_usage['completion_tokens'] += completion_tokens
+        logger.info(
+            f"Ответ пользователю {user_id}: промпт {prompt_tokens} токенов "
+            f"(оценка {prompt_usage['prompt_tokens']}, контекст {prompt_usage['context_tokens']}, "
+            f"отрезков {prompt_usage['chunks_used']}/{prompt_usage['chunks_total']}, "
+            f"история {prompt_usage['history_tokens']}), ответ {completion_tokens} токенов"
+        )
+    
+    def _flight_key(self, query, history, kb, k):
+        """Ключ объединения запросов: одинаковый вопрос с одинаковой историей по одной версии базы знаний"""
+        return (normalize_query(query), tuple((normalize_query(q), a) for q, a in history), kb.version, k)
+    
+    async def _retrieve_context(self, query: str, k: int, kb, cache_version=None):
+        """
+        Поиск отрезков базы знаний для вопроса: BM25, а если его результат не уверенный -
+        эмбеддинг вопроса и гибридный поиск по FAISS и BM25.
+        Если передана версия базы знаний для кэша ответов, до поиска проверяется кэш.
+        
+        Returns:
+            tuple: (готовый ответ из кэша или None, отрезки, эмбеддинг или None)
+        """
+        # Сначала ищем по лексическому индексу: он работает без обращения к API
+        lexical_docs, confident = self.lexical_search(query, k, kb)
+        if confident and settings.KB_LEXICAL_SKIP_EMBEDDING:
+            # Уверенный результат BM25: эмбеддинг не запрашиваем, кэш ответов проверяем по тексту вопроса
+            if cache_version:
+                cached_answer = self.answer_cache.get_exact(query, cache_version)
+                if cached_answer is not None:
+                    return cached_answer, None, None
+            return None, lexical_docs[:k], None
+        
+        embedding = await self.embed_query_or_none(query, lexical_docs)
+        if embedding is None:
+            return None, lexical_docs[:k], None
+        if cache_version:
+            cached_answer = self.answer_cache.get(embedding, cache_version)
+            if cached_answer is not None:
+                return cached_answer, None, embedding
+        
+        # Получаем релевантные отрезки из базы знаний
+        return None, await self.hybrid_search(embedding, lexical_docs, k, kb), embedding
+    
+    async def _prepare(self, query: str, history, kb, k: int):
+        """
+        Готовит запрос к модели: ищет ответ в кэше или собирает промпт.
+        
+        Returns:
+            tuple: (готовый ответ из кэша или None, сообщения для модели, статистика токенов промпта,
+                    эмбеддинг, версия базы знаний для кэша ответов или None, если кэш не используется)
+        """
+        # Кэш ответов используем только для вопросов без предыдущей истории,
+        # иначе сохраненный ответ может не учитывать контекст диалога
+        cache_version = None if history else kb.version
+        k = k or settings.KB_RETRIEVAL_K
+        
+        cached_answer, docs, embedding = await self._retrieve_context(query, k, kb, cache_version)
+        if cached_answer is not None:
+            return cached_answer, None, None, embedding, cache_version
+        
+        # Собираем промпт в пределах бюджета токенов: отрезки в порядке релевантности
+        messages, prompt_usage = build_prompt(kb.system, query, [self.chunk_text(d) for d in docs], history,
+                                              settings.PROMPT_TOKEN_BUDGET, settings.PROMPT_HISTORY_TOKEN_BUDGET)
+        return None, messages, prompt_usage, embedding, cache_version
+    
+    def _cache_answer(self, query, answer, embedding, cache_version):
+        """Сохраняет ответ в кэш ответов"""
+        # Ответ, построенный без эмбеддинга (по BM25), найдется в кэше только по точному тексту вопроса.
+        # Ответ по устаревшей версии базы знаний в кэш не сохраняем
+        if cache_version and cache_version == self.kb.version:
+            self.answer_cache.set(query, embedding, answer, cache_version)
+    
+    async def _generate_answer(self, query, user_id, history, kb, k):
+        """Ответ модели на вопрос (или готовый ответ из кэша) без сохранения в историю"""
+        cached_answer, messages, prompt_usage, embedding, cache_version = await self._prepare(query, history, kb, k)
+        if cached_answer is not None:
+            return cached_answer
+        
+        # Отправляем в OpenAI, дождавшись места в очереди; пользователи, уже ведущие диалог, идут первыми
+        async with self.admission.slot(priority=bool(history)):
+            resp = await self._get_client().chat.completions.create(
                 model='gpt-4o',
-                messages=[{'role': 'system', 'content': self.system},
-                          {'role': 'user', 'content': user}],
+                messages=messages,
                 temperature=0
             )
+        
+        answer = resp.choices[0].message.content
+        self._record_usage(user_id, prompt_usage, resp.usage)
+        self._cache_answer(query, answer, embedding, cache_version)
+        return answer
+    
+    async def _generate_stream(self, query, user_id, history, kb, k):
+        """Потоковый ответ модели (или готовый ответ из кэша) без сохранения в историю"""
+        cached_answer, messages, prompt_usage, embedding, cache_version = await self._prepare(query, history, kb, k)
+        if cached_answer is not None:
+            yield cached_answer
+            return
+        
+        parts = []
+        usage = None
+        # Место в очереди к модели занято, пока не получен весь ответ
+        async with self.admission.slot(priority=bool(history)):
+            stream = await self._get_client().chat.completions.create(
+                model='gpt-4o',
+                messages=messages,
+                temperature=0,
+                stream=True,
+                # Последний фрагмент потока содержит фактический расход токенов
+                stream_options={'include_usage': True}
+            )
             
-            answer = resp.choices[0].message.content
-            
-            # Сохраняем диалог в историю
-            self.conversations[user_id].append({
-                'user': query,
-                'assistant': answer,
-                'timestamp': datetime.now().isoformat()
-            })
+            async for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        
+        self._record_usage(user_id, prompt_usage, usage)
+        self._cache_answer(query, ''.join(parts), embedding, cache_version)
+    
+    async def get_answer(self, query: str, user_id: str, k: int = None) -> str:
+        """Получение ответа на вопрос пользователя с учетом истории диалога"""
+        try:
+            # Весь ответ строится по одной версии базы знаний, даже если она обновится во время запроса
+            kb = self.kb
+            # Получаем последние ходы диалога пользователя
+            history = await self.conversations.get(user_id)
             
-            # Ограничиваем историю, чтобы не хранить слишком много
-            if len(self.conversations[user_id]) > 10:
-                self.conversations[user_id] = self.conversations[user_id][-10:]
+            # Одинаковые вопросы, заданные одновременно, отправляются в OpenAI один раз
+            key = self._flight_key(query, history, kb, k)
+            answer = await self.flights.run(key, lambda: self._generate_answer(query, user_id, history, kb, k))
             
+            # Сохраняем диалог в историю
+            self._remember(user_id, query, answer)
             return answer
+        except Overloaded:
+            # Перегрузку обрабатывает вызывающий код (см. fallback_answer)
+            raise
+        except API_OVERLOAD_ERRORS as e:
+            # Эмбеддинги или ответ модели отклонены из-за нагрузки - обрабатываем как перегрузку
+            raise Overloaded(f"OpenAI перегружен: {e}") from e
         except Exception as e:
             print(f"Ошибка при получении ответа: {str(e)}")
             return f"Произошла ошибка: {str(e)}"
+    
+    async def stream_answer(self, query: str, user_id: str, k: int = None):
+        """
+        Потоковое получение ответа: отдает текст частями по мере генерации.
+        
+        Args:
+            query (str): Вопрос пользователя
+            user_id (str): ID пользователя
+            k (int): Количество отрезков базы знаний для контекста
+        
+        Yields:
+            str: Очередной фрагмент ответа
+        
+        Raises:
+            Overloaded: Очередь к модели переполнена или OpenAI перегружен, ответ не начат
+        """
+        parts = []
+        try:
+            kb = self.kb
+            history = await self.conversations.get(user_id)
+            key = self._flight_key(query, history, kb, k)
+            
+            async for delta in self.flights.stream(key, lambda: self._generate_stream(query, user_id, history, kb, k)):
+                parts.append(delta)
+                yield delta
+            
+            # Сохраняем диалог в историю только после получения полного ответа
+            self._remember(user_id, query, ''.join(parts))
+        except Overloaded:
+            raise
+        except API_OVERLOAD_ERRORS as e:
+            if parts:
+                # Часть ответа уже отправлена - дописываем сообщение об ошибке
+                print(f"Ошибка при получении ответа: {str(e)}")
+                yield f"Произошла ошибка: {str(e)}"
+            else:
+                raise Overloaded(f"OpenAI перегружен: {e}") from e
+        except Exception as e:
+            print(f"Ошибка при получении ответа: {str(e)}")
+            yield f"Произошла ошибка: {str(e)}"
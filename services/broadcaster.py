@@ -0,0 +1,209 @@
+import asyncio
+import html
+import time
+import logging
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from config.settings import settings
+from database.admin_models import count_users_in_segment, get_segment_user_ids_page
+from database.broadcast_models import get_broadcast_job, get_running_broadcast_job_ids, add_broadcast_recipients
+from database.broadcast_models import set_recipient_statuses, update_broadcast_checkpoint, finish_broadcast_job
+from database.broadcast_models import get_broadcast_stats
+from database.write_queue import BatchWriter
+
+logger = logging.getLogger(__name__)
+
+# Фоновые задачи рассылок (храним ссылки, чтобы задачи не были собраны сборщиком мусора)
+running_broadcasts = set()
+
+# Очередь записи результатов доставки
+recipient_writer = BatchWriter('broadcast_recipients', set_recipient_statuses)
+
+
+class TokenBucket:
+    """Ограничитель частоты: не больше rate операций в секунду с запасом capacity"""
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def pause(self, seconds):
+        """Приостанавливает выдачу токенов (например, после RetryAfter от Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Broadcaster:
+    """Рассылка сообщений с ограничением частоты, параллельной отправкой и повтором при RetryAfter"""
+    
+    def __init__(self, bot, text, parse_mode="HTML"):
+        self.bot = bot
+        self.text = text
+        self.parse_mode = parse_mode
+        self.bucket = TokenBucket(settings.BROADCAST_RATE)
+    
+    async def send_one(self, user_id):
+        """
+        Отправляет сообщение одному получателю.
+        
+        Returns:
+            tuple: (статус 'sent', 'blocked' или 'failed', текст ошибки или None)
+        """
+        error = None
+        for attempt in range(settings.BROADCAST_MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=user_id, text=self.text, parse_mode=self.parse_mode)
+                return "sent", None
+            except TelegramRetryAfter as e:
+                # Telegram просит подождать - останавливаем всю рассылку на указанное время
+                logger.warning(f"Превышен лимит Telegram, пауза {e.retry_after} с")
+                self.bucket.pause(e.retry_after)
+                error = str(e)
+            except TelegramForbiddenError as e:
+                return "blocked", str(e)
+            except TelegramBadRequest as e:
+                if "chat not found" in str(e).lower():
+                    return "blocked", str(e)
+                logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+                return "failed", str(e)
+            except Exception as e:
+                logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+                return "failed", str(e)
+        return "failed", error
+    
+    async def send_batch(self, job_id, user_ids):
+        """Отправляет сообщение пачке получателей параллельно и записывает результаты в журнал доставки"""
+        semaphore = asyncio.Semaphore(settings.BROADCAST_CONCURRENCY)
+        
+        async def deliver(user_id):
+            async with semaphore:
+                status, error = await self.send_one(user_id)
+            # Результат записываем сразу, чтобы после перезапуска не отправить сообщение повторно
+            return recipient_writer.submit((job_id, user_id, status, error))
+        
+        saved = await asyncio.gather(*(deliver(user_id) for user_id in user_ids))
+        await asyncio.gather(*saved)
+
+
+def format_broadcast_progress(job, stats, total):
+    done = stats['sent'] + stats['failed'] + stats['blocked']
+    return (
+        f"Рассылка пользователям {job['segment_description']}: {done} из {total}...\n"
+        f"✓ Отправлено: {stats['sent']}, ✗ Ошибок: {stats['failed']}, 🚫 Заблокировали бота: {stats['blocked']}"
+    )
+
+
+async def run_broadcast_job(bot, job_id):
+    """
+    Выполняет (или продолжает после перезапуска) сохраненную рассылку.
+    
+    Получатели выбираются из базы постранично по возрастанию user_id, после
+    каждой страницы сохраняется контрольная точка. Получатели, которым
+    сообщение уже было доставлено, при продолжении пропускаются.
+    """
+    job = await get_broadcast_job(job_id)
+    if not job or job['status'] != 'running':
+        return
+    
+    broadcaster = Broadcaster(bot, job['text'])
+    total = await count_users_in_segment(job['segment_type'], job['segment_value'])
+    after_user_id = job['last_user_id'] or 0
+    last_progress = time.monotonic()
+    logger.info(f"Рассылка {job_id}: старт с user_id > {after_user_id}, получателей в сегменте: {total}")
+    
+    error = None
+    try:
+        while True:
+            page = await get_segment_user_ids_page(job['segment_type'], job['segment_value'],
+                                                   after_user_id, settings.BROADCAST_BATCH_SIZE)
+            if not page:
+                break
+            
+            pending = await add_broadcast_recipients(job_id, page)
+            await broadcaster.send_batch(job_id, pending)
+            
+            after_user_id = page[-1]
+            await update_broadcast_checkpoint(job_id, after_user_id)
+            
+            # Периодически обновляем сообщение с прогрессом рассылки
+            if time.monotonic() - last_progress >= settings.BROADCAST_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                try:
+                    stats = await get_broadcast_stats(job_id)
+                    await bot.edit_message_text(text=format_broadcast_progress(job, stats, total),
+                                                chat_id=job['admin_chat_id'],
+                                                message_id=job['progress_message_id'])
+                except Exception as e:
+                    logger.warning(f"Не удалось обновить прогресс рассылки: {e}")
+        
+        await finish_broadcast_job(job_id, 'done')
+    except asyncio.CancelledError:
+        # Остановка бота: задание остается в статусе running и продолжится после перезапуска
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении рассылки {job_id}: {e}", exc_info=True)
+        await finish_broadcast_job(job_id, 'failed')
+        error = e
+    
+    stats = await get_broadcast_stats(job_id)
+    logger.info(f"Рассылка {job_id} завершена: {stats}")
+    
+    # Отправляем сообщение об окончании рассылки
+    if error is not None:
+        await bot.send_message(
+            chat_id=job['admin_chat_id'],
+            text=f"❌ Рассылка {job_id} прервана из-за ошибки: {html.escape(str(error))}\n\n"
+                 f"✓ Успели отправить: {stats['sent']} из {total}",
+            parse_mode="HTML"
+        )
+        return
+    await bot.send_message(
+        chat_id=job['admin_chat_id'],
+        text=f"✅ Рассылка завершена!\n\n"
+             f"📊 <b>Статистика:</b>\n"
+             f"✓ Успешно отправлено: {stats['sent']}\n"
+             f"✗ Ошибок: {stats['failed']}\n"
+             f"🚫 Заблокировали бота: {stats['blocked']}",
+        parse_mode="HTML"
+    )
+
+
+def start_broadcast_job(bot, job_id):
+    """Запускает рассылку в фоновой задаче, не блокируя обработчик"""
+    task = asyncio.create_task(run_broadcast_job(bot, job_id))
+    running_broadcasts.add(task)
+    task.add_done_callback(running_broadcasts.discard)
+    return task
+
+
+async def resume_broadcasts(bot):
+    """Продолжает рассылки, прерванные остановкой бота"""
+    for job_id in await get_running_broadcast_job_ids():
+        logger.info(f"Продолжаем прерванную рассылку {job_id}")
+        start_broadcast_job(bot, job_id)
+
+
+async def stop_broadcasts():
+    """Останавливает текущие рассылки и дописывает журнал доставки"""
+    for task in list(running_broadcasts):
+        task.cancel()
+    await asyncio.gather(*running_broadcasts, return_exceptions=True)
+    await recipient_writer.stop()
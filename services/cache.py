@@ -0,0 +1,130 @@
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_query(text):
+    """Приводит вопрос к нормальной форме для использования в качестве ключа кэша"""
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+class TTLCache:
+    """LRU-кэш с ограничением времени жизни записей и счетчиками попаданий"""
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (время записи, значение)
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None or time.monotonic() - item[0] > self.ttl:
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+    
+    def set(self, key, value):
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def clear(self):
+        self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
+
+
+class SemanticAnswerCache:
+    """
+    Кэш ответов по смыслу вопроса: возвращает сохраненный ответ,
+    если косинусная близость нового вопроса к сохраненному не ниже порога.
+    Все записи привязаны к версии базы знаний: запросы по другой версии получают промах,
+    а сами записи сбрасываются при первом сохранении ответа по новой версии.
+    """
+    
+    def __init__(self, maxsize, ttl, threshold):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.kb_hash = None
+        self._entries = OrderedDict()  # нормализованный вопрос -> (время, вектор, ответ)
+        self.hits = 0
+        self.misses = 0
+    
+    def _check_version(self, kb_hash):
+        """Сбрасывает кэш при записи ответа по новой версии базы знаний"""
+        if kb_hash != self.kb_hash:
+            self._entries.clear()
+            self.kb_hash = kb_hash
+    
+    def get(self, embedding, kb_hash, threshold=None):
+        """Ответ на самый близкий вопрос, если близость не ниже threshold (по умолчанию - порога кэша)"""
+        # Записи другой версии не подходят, но и не сбрасываются: после обновления базы знаний
+        # запросы по старой и новой версиям некоторое время выполняются одновременно
+        if kb_hash != self.kb_hash:
+            self.misses += 1
+            return None
+        now = time.monotonic()
+        for key in [k for k, item in self._entries.items() if now - item[0] > self.ttl]:
+            del self._entries[key]
+        
+        # Записи без вектора доступны только для точного совпадения вопроса (get_exact)
+        keys = [key for key, item in self._entries.items() if item[1] is not None]
+        if not keys:
+            self.misses += 1
+            return None
+        
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        matrix = np.stack([self._entries[key][1] for key in keys])
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        
+        if scores[best] < (self.threshold if threshold is None else threshold):
+            self.misses += 1
+            return None
+        self._entries.move_to_end(keys[best])
+        self.hits += 1
+        return self._entries[keys[best]][2]
+    
+    def get_exact(self, query, kb_hash):
+        """Ответ на тот же вопрос (после нормализации) без сравнения эмбеддингов"""
+        if kb_hash != self.kb_hash:
+            self.misses += 1
+            return None
+        key = normalize_query(query)
+        item = self._entries.get(key)
+        if item is None or time.monotonic() - item[0] > self.ttl:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return item[2]
+    
+    def set(self, query, embedding, answer, kb_hash):
+        self._check_version(kb_hash)
+        vector = None
+        if embedding is not None:
+            vector = np.asarray(embedding, dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+        key = normalize_query(query)
+        self._entries[key] = (time.monotonic(), vector, answer)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    
+    def clear(self):
+        self._entries.clear()
+    
+    def __len__(self):
+        return len(self._entries)
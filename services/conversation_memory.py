@@ -0,0 +1,98 @@
+import time
+import logging
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+
+from database.models import get_recent_messages
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationMemory:
+    """
+    Ограниченная по размеру память диалогов.
+
+    Для каждого пользователя хранится кольцевой буфер последних ходов (вопрос, ответ).
+    Пользователи упорядочены по времени последнего обращения: при превышении max_users
+    и по истечении idle_ttl без активности их история выгружается из памяти.
+    Вопросы и ответы уже сохраняются в таблице messages, поэтому при следующем
+    обращении выгруженного пользователя история восстанавливается оттуда
+    (только за последние idle_ttl секунд).
+    """
+
+    def __init__(self, max_turns, max_users, idle_ttl, restore_from_db=True):
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self.restore_from_db = restore_from_db
+        self._users = OrderedDict()  # user_id -> (время последнего обращения, deque[(вопрос, ответ)])
+        self.evictions = 0
+        self.restores = 0
+
+    async def get(self, user_id):
+        """
+        Возвращает последние ходы диалога пользователя.
+
+        Returns:
+            list: Кортежи (вопрос, ответ) от старых к новым
+        """
+        item = self._users.get(user_id)
+        if item is None:
+            turns = await self._load(user_id)
+            # Пока шла загрузка, пользователь мог получить ответ в другом обработчике
+            item = self._users.get(user_id)
+            if item is None:
+                item = (time.monotonic(), turns)
+        self._touch(user_id, item[1])
+        self._evict()
+        return list(item[1])
+
+    def append(self, user_id, query, answer):
+        """Добавляет ход диалога в историю пользователя"""
+        item = self._users.get(user_id)
+        turns = item[1] if item else deque(maxlen=self.max_turns)
+        turns.append((query, answer))
+        self._touch(user_id, turns)
+        self._evict()
+
+    def _touch(self, user_id, turns):
+        self._users[user_id] = (time.monotonic(), turns)
+        self._users.move_to_end(user_id)
+
+    def _evict(self):
+        """Выгружает пользователей сверх лимита и неактивных дольше idle_ttl"""
+        now = time.monotonic()
+        while self._users:
+            user_id, (last_access, _) = next(iter(self._users.items()))
+            if len(self._users) <= self.max_users and now - last_access <= self.idle_ttl:
+                break
+            del self._users[user_id]
+            self.evictions += 1
+
+    async def _load(self, user_id):
+        """Восстанавливает последние ходы диалога из таблицы messages"""
+        turns = deque(maxlen=self.max_turns)
+        if not self.restore_from_db:
+            return turns
+        since = (datetime.now() - timedelta(seconds=self.idle_ttl)).strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            rows = await get_recent_messages(user_id, since, self.max_turns)
+        except Exception as e:
+            logger.error(f"Не удалось восстановить историю диалога пользователя {user_id}: {e}")
+            return turns
+        turns.extend(rows)
+        if rows:
+            self.restores += 1
+        return turns
+
+    def stats(self):
+        """Метрики памяти: число пользователей и ходов в памяти, выгрузки и восстановления"""
+        return {
+            'users': len(self._users),
+            'turns': sum(len(turns) for _, turns in self._users.values()),
+            'evictions': self.evictions,
+            'restores': self.restores,
+        }
+
+    def __len__(self):
+        return len(self._users)
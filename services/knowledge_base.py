@@ -0,0 +1,161 @@
+import re
+import hashlib
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain.docstore.document import Document
+
+# Заголовок курса или продукта: «1. Курс «Цифровой педагог»», «6. Гайд репетитора»
+COURSE_HEADING_RE = re.compile(r'^\d+\.\s*(Курс|Вебинар|Гайд|Автопрактикум|Практикум|Интенсив|Мастер-класс|МК|Библиотека)',
+                               re.IGNORECASE)
+# Строка со ссылкой на курс: «ссылка на курс «...» - cifrovoipedagog.online/...»
+COURSE_LINK_RE = re.compile(r'ссылка на[^\n]*?-\s*((?:https?://)?[\w.-]+\.\w+/\S+)', re.IGNORECASE)
+# Максимальная длина строки-заголовка
+HEADING_MAX_LENGTH = 80
+
+
+def is_heading(line):
+    """Короткая строка без завершающей точки, запятой или двоеточия считается заголовком"""
+    text = line.strip()
+    if len(text) < 3 or len(text) > HEADING_MAX_LENGTH:
+        return False
+    if text[0] in '-•–—*' or text[-1] in '.,;:' or 'http' in text:
+        return False
+    return True
+
+
+def split_sections(text):
+    """
+    Разбивает текст базы знаний на разделы по заголовкам.
+
+    Заголовок после двух и более пустых строк начинает раздел верхнего уровня,
+    нумерованный заголовок курса («1. Курс ...») - описание курса, которое
+    продолжается до следующего курса или раздела верхнего уровня.
+
+    Returns:
+        list: Словари {'top', 'course', 'heading', 'text'} в порядке следования
+    """
+    sections = []
+    top = course = heading = ''
+    lines = []
+    has_body = False
+    blank_lines = 2  # начало файла считается началом раздела верхнего уровня
+
+    def flush():
+        # Подряд идущие заголовки без текста присоединяются к следующему разделу
+        if has_body:
+            sections.append({'top': top, 'course': course, 'heading': heading, 'text': '\n'.join(lines).strip()})
+            lines.clear()
+
+    for line in text.splitlines():
+        if not line.strip():
+            blank_lines += 1
+            lines.append('')
+            continue
+        if is_heading(line):
+            flush()
+            has_body = False
+            heading = line.strip()
+            if COURSE_HEADING_RE.match(heading):
+                course = heading
+            elif blank_lines >= 2:
+                top, course = heading, ''
+        else:
+            has_body = True
+        lines.append(line.rstrip())
+        blank_lines = 0
+    has_body = has_body or any(lines)
+    flush()
+    return sections
+
+
+def course_links(sections):
+    """Ссылки на курсы: заголовок курса -> первая ссылка в его описании"""
+    links = {}
+    for section in sections:
+        if section['course'] and section['course'] not in links:
+            match = COURSE_LINK_RE.search(section['text'])
+            if match:
+                links[section['course']] = match.group(1)
+    return links
+
+
+def build_chunks(text, chunk_size, chunk_overlap):
+    """
+    Разбивает базу знаний на небольшие отрезки с учетом структуры заголовков.
+
+    Соседние разделы одного курса или раздела верхнего уровня объединяются, пока
+    помещаются в chunk_size символов; слишком длинные разделы делятся с перекрытием.
+    Каждый отрезок начинается с пути заголовков, чтобы эмбеддинг учитывал, к чему
+    относится текст.
+
+    Returns:
+        list: Document с метаданными 'section', 'top', 'course', 'link'
+    """
+    sections = split_sections(text)
+    links = course_links(sections)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    chunks = []
+    group = []
+
+    def flush_group():
+        if not group:
+            return
+        first = group[0]
+        body = '\n\n'.join(section['text'] for section in group)
+        path = ' / '.join(part for part in (first['top'], first['course']) if part and part != first['heading'])
+        metadata = {
+            'section': first['heading'],
+            'top': first['top'],
+            'course': first['course'],
+            'link': links.get(first['course'], ''),
+        }
+        for part in splitter.split_text(body):
+            content = f"{path}\n{part}" if path else part
+            chunks.append(Document(page_content=content, metadata=dict(metadata)))
+        group.clear()
+
+    for section in sections:
+        if group and ((section['top'], section['course']) != (group[0]['top'], group[0]['course'])
+                      or sum(len(s['text']) for s in group) + len(section['text']) > chunk_size):
+            flush_group()
+        group.append(section)
+    flush_group()
+    return chunks
+
+
+def build_plain_chunks(text, chunk_size, chunk_overlap):
+    """Разбивает базу знаний на отрезки фиксированного размера без учета структуры"""
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return [Document(page_content=chunk.page_content, metadata={})
+            for chunk in splitter.create_documents([text])]
+
+
+def content_hash(text):
+    """Хэш текста отрезка для переиспользования его эмбеддинга"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class KnowledgeBase:
+    """
+    Версия базы знаний: FAISS-индекс, лексический индекс и системный промпт.
+
+    Объект не изменяется после создания, поэтому обновление базы знаний - это
+    замена ссылки на новый объект, а запросы в процессе дорабатывают со старым.
+    """
+    __slots__ = ('db', 'lexical', 'kb_hash', 'system', 'version')
+
+    def __init__(self, db, lexical, kb_hash, system):
+        self.db = db
+        self.lexical = lexical
+        self.kb_hash = kb_hash
+        self.system = system
+        # Версия для кэша ответов учитывает и базу знаний, и системный промпт
+        self.version = hashlib.sha256(f"{kb_hash}\n{system}".encode('utf-8')).hexdigest()[:16]
+
+    def vectors_by_hash(self):
+        """Эмбеддинги отрезков индекса: хэш текста -> вектор"""
+        vectors = {}
+        for position, doc_id in self.db.index_to_docstore_id.items():
+            doc = self.db.docstore.search(doc_id)
+            vectors[content_hash(doc.page_content)] = self.db.index.reconstruct(position).tolist()
+        return vectors
@@ -0,0 +1,82 @@
+import re
+import math
+from collections import Counter, defaultdict
+from functools import lru_cache
+
+import snowballstemmer
+
+# Служебные слова, которые не несут смысла для поиска
+STOP_WORDS = frozenset('''
+а без более бы был была были было быть в вам вас ваш ваша ваше ваши во вот все всё вы где да для до
+его ее её если есть еще ещё же за и из или им их к как какая какие какой когда кто ли либо мне мной
+мы на над не него нее неё нет ни них но ну о об однако он она они оно от по под при про с со так
+также такой там те тем то того тоже той только том ты у уже хочу чем что чтобы чье чья эта эти это
+я можно нужно
+'''.split())
+
+_TOKEN_RE = re.compile(r'[a-zа-я0-9]+')
+_russian_stemmer = snowballstemmer.stemmer('russian')
+_english_stemmer = snowballstemmer.stemmer('english')
+
+
+@lru_cache(maxsize=50000)
+def stem(word):
+    """Основа слова: русский или английский стеммер Snowball в зависимости от алфавита"""
+    if re.match(r'[a-z]', word):
+        return _english_stemmer.stemWord(word)
+    return _russian_stemmer.stemWord(word)
+
+
+def tokenize(text):
+    """Разбивает текст на основы слов без служебных слов"""
+    words = _TOKEN_RE.findall(text.lower().replace('ё', 'е'))
+    return [stem(word) for word in words if word not in STOP_WORDS and len(word) > 1]
+
+
+class BM25Index:
+    """
+    Инвертированный индекс BM25 по отрезкам базы знаний.
+
+    Поиск выполняется в памяти процесса без обращения к API и занимает доли миллисекунды
+    на базе из сотен отрезков.
+    """
+
+    def __init__(self, docs, k1=1.5, b=0.75):
+        self.docs = docs
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)  # основа слова -> [(номер отрезка, частота)]
+        self.doc_lengths = []
+        for number, doc in enumerate(docs):
+            terms = Counter(tokenize(doc.page_content))
+            self.doc_lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                self.postings[term].append((number, frequency))
+        self.avg_length = (sum(self.doc_lengths) / len(docs)) if docs else 0.0
+
+    def idf(self, term):
+        count = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.docs) - count + 0.5) / (count + 0.5))
+
+    def search(self, query, k):
+        """
+        Returns:
+            tuple: (список (номер отрезка, оценка) по убыванию оценки,
+                    уверенность от 0 до 1 - доля максимально возможной оценки у лучшего отрезка)
+        """
+        terms = set(tokenize(query))
+        if not terms or not self.docs:
+            return [], 0.0
+        scores = defaultdict(float)
+        for term in terms:
+            idf = self.idf(term)
+            for number, frequency in self.postings.get(term, ()):
+                length_norm = 1 - self.b + self.b * self.doc_lengths[number] / self.avg_length
+                scores[number] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        hits = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        if not hits:
+            return [], 0.0
+        # Оценка слагаемого BM25 не превышает idf * (k1 + 1), а слова, которых нет в базе,
+        # дают максимальный idf - поэтому такие вопросы не считаются уверенно найденными
+        max_score = sum(self.idf(term) * (self.k1 + 1) for term in terms)
+        return hits, hits[0][1] / max_score
@@ -0,0 +1,22 @@
+import httpx
+from openai import AsyncOpenAI
+from config.settings import settings
+
+
+def create_llm_client():
+    """Создает общий клиент OpenAI с пулом соединений и keep-alive"""
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=settings.OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=settings.OPENAI_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(settings.OPENAI_TIMEOUT, connect=settings.OPENAI_CONNECT_TIMEOUT)
+    )
+    # Повторы с экспоненциальной задержкой (429, 5xx, обрывы соединения) выполняет сам клиент OpenAI
+    return AsyncOpenAI(
+        api_key=settings.OPENAI_API_KEY,
+        http_client=http_client,
+        max_retries=settings.OPENAI_MAX_RETRIES,
+        timeout=settings.OPENAI_TIMEOUT
+    )
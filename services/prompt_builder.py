@@ -0,0 +1,122 @@
+import logging
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# Кодировка токенизатора, загружается один раз при запуске (см. load_encoding)
+_encoding = None
+_encoding_loaded = False
+
+
+def load_encoding(model='gpt-4o'):
+    """
+    Загружает кодировку токенизатора. На новом сервере tiktoken скачивает файл кодировки
+    синхронно, поэтому функция вызывается при запуске, а не во время ответа пользователю.
+    """
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            _encoding = tiktoken.encoding_for_model(model)
+        except Exception as e:
+            # Без доступа к файлам кодировки считаем токены приближенно
+            logger.warning(f"Не удалось загрузить токенизатор для {model}: {e}, используется оценка по длине текста")
+    return _encoding
+
+
+def count_tokens(text, model='gpt-4o'):
+    """Количество токенов в тексте (при недоступном токенизаторе - оценка 1 токен на 4 символа)"""
+    encoding = load_encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text))
+
+
+def truncate_to_tokens(text, max_tokens, model='gpt-4o'):
+    """Обрезает текст до max_tokens токенов"""
+    if max_tokens <= 0:
+        return ''
+    encoding = load_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def build_prompt(system, query, chunks, history, budget, history_budget, model='gpt-4o'):
+    """
+    Собирает сообщения для модели так, чтобы промпт уложился в бюджет токенов.
+
+    Системный промпт и вопрос включаются всегда. История диалога занимает не больше
+    history_budget токенов (сначала самые свежие ходы). Оставшийся бюджет заполняется
+    отрезками базы знаний в порядке релевантности; отрезок, который не помещается
+    целиком, обрезается.
+
+    Args:
+        system (str): Системный промпт
+        query (str): Вопрос пользователя
+        chunks (list): Тексты отрезков базы знаний, от более релевантных к менее
+        history (list): Кортежи (вопрос, ответ) от старых к новым
+        budget (int): Бюджет токенов на весь промпт
+        history_budget (int): Бюджет токенов на историю диалога
+
+    Returns:
+        tuple: (сообщения для модели, статистика {'prompt_tokens', 'context_tokens',
+               'history_tokens', 'chunks_used', 'chunks_total', 'history_used'})
+    """
+    header = "Ответь на вопрос клиента по компании Цифровой Педагог. Контекст: "
+    question = f"Вопрос: {query}"
+    # Несколько токенов на служебную разметку каждого сообщения чата
+    remaining = budget - count_tokens(system, model) - count_tokens(header, model) - count_tokens(question, model) - 10
+
+    # История: от новых ходов к старым, пока помещается
+    history_lines = []
+    history_tokens = 0
+    history_limit = min(history_budget, max(remaining, 0))
+    for user_message, assistant_message in reversed(history):
+        line = f"Пользователь: {user_message}\nАссистент: {assistant_message}\n"
+        tokens = count_tokens(line, model)
+        if history_tokens + tokens > history_limit:
+            break
+        history_lines.insert(0, line)
+        history_tokens += tokens
+    conversation_history = ""
+    if history_lines:
+        conversation_history = "История диалога:\n" + ''.join(history_lines)
+        history_tokens += count_tokens("История диалога:\n", model)
+    remaining -= history_tokens
+
+    # Контекст: отрезки по убыванию релевантности
+    context_parts = []
+    context_tokens = 0
+    for chunk in chunks:
+        tokens = count_tokens(chunk, model) + 1
+        if context_tokens + tokens > remaining:
+            rest = truncate_to_tokens(chunk, remaining - context_tokens - 1, model)
+            if rest:
+                context_parts.append(rest)
+                context_tokens += count_tokens(rest, model) + 1
+            break
+        context_parts.append(chunk)
+        context_tokens += tokens
+    context = "\n".join(context_parts)
+
+    user = (
+        f"{header}{context}\n"
+        f"{conversation_history}\n"
+        f"{question}"
+    )
+    messages = [{'role': 'system', 'content': system},
+                {'role': 'user', 'content': user}]
+    usage = {
+        'prompt_tokens': count_tokens(system, model) + count_tokens(user, model),
+        'context_tokens': context_tokens,
+        'history_tokens': history_tokens,
+        'chunks_used': len(context_parts),
+        'chunks_total': len(chunks),
+        'history_used': len(history_lines),
+    }
+    return messages, usage
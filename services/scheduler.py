@@ -0,0 +1,165 @@
+import asyncio
+import json
+import math
+import time
+import logging
+
+from database.database import get_connection
+from database.write_queue import BatchWriter
+
+logger = logging.getLogger(__name__)
+
+
+async def save_timer_changes(changes):
+    """
+    Сохраняет изменения отложенных задач одной транзакцией.
+    
+    Args:
+        changes (list): Кортежи (key, kind, payload, due_at); kind=None означает удаление
+    """
+    async with get_connection(write=True) as conn:
+        for key, kind, payload, due_at in changes:
+            if kind is None:
+                await conn.execute('DELETE FROM scheduled_timers WHERE key = ?', (key,))
+            else:
+                await conn.execute('''
+                    INSERT INTO scheduled_timers (key, kind, payload, due_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET
+                        kind = excluded.kind,
+                        payload = excluded.payload,
+                        due_at = excluded.due_at
+                ''', (key, kind, json.dumps(payload, ensure_ascii=False), due_at))
+        await conn.commit()
+
+
+class TimerWheel:
+    """
+    Планировщик отложенных задач на хэшированном колесе таймеров.
+    
+    Все таймеры обслуживает одна фоновая задача, которая раз в tick секунд
+    переходит к следующей ячейке колеса. Постановка, перенос и отмена таймера
+    выполняются за O(1) по ключу, повторная постановка с тем же ключом заменяет
+    прежний таймер. Таймеры сохраняются в базе и восстанавливаются после перезапуска.
+    """
+    
+    def __init__(self, tick=1.0, slots=3600):
+        self.tick = tick
+        self._slots = [dict() for _ in range(slots)]  # ячейка -> {key: [rounds, kind, payload, due_at]}
+        self._index = {}  # key -> номер ячейки
+        self._cursor = 0
+        self._handlers = {}  # kind -> (async fn(bot, payload), fn(payload) для восстановления)
+        self._writer = BatchWriter('scheduled_timers', save_timer_changes)
+        self._task = None
+        self._running = set()
+        self.bot = None
+    
+    def register(self, kind, handler, restore=None):
+        """
+        Регистрирует обработчик таймеров данного типа.
+        
+        Args:
+            kind (str): Тип таймера
+            handler: async fn(bot, payload), вызывается при срабатывании
+            restore: fn(payload), вызывается для таймеров, загруженных из базы при запуске
+        """
+        self._handlers[kind] = (handler, restore)
+    
+    def _place(self, key, kind, payload, due_at):
+        ticks = max(1, math.ceil((due_at - time.time()) / self.tick))
+        slot = (self._cursor + ticks) % len(self._slots)
+        self._slots[slot][key] = [(ticks - 1) // len(self._slots), kind, payload, due_at]
+        self._index[key] = slot
+    
+    def _remove(self, key):
+        slot = self._index.pop(key, None)
+        if slot is not None:
+            self._slots[slot].pop(key, None)
+        return slot is not None
+    
+    def schedule(self, key, kind, delay, payload=None):
+        """Ставит (или переносит) таймер с ключом key на delay секунд"""
+        due_at = time.time() + delay
+        self._remove(key)
+        self._place(key, kind, payload or {}, due_at)
+        self._persist(key, kind, payload or {}, due_at)
+    
+    def cancel(self, key):
+        """Отменяет таймер с ключом key, если он есть"""
+        if self._remove(key):
+            self._persist(key, None, None, None)
+    
+    def _persist(self, key, kind, payload, due_at):
+        if self._task is not None:
+            self._writer.submit((key, kind, payload, due_at))
+    
+    def __len__(self):
+        return len(self._index)
+    
+    async def _load(self):
+        async with get_connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('SELECT key, kind, payload, due_at FROM scheduled_timers')
+                rows = await cursor.fetchall()
+        for key, kind, payload, due_at in rows:
+            payload = json.loads(payload) if payload else {}
+            self._place(key, kind, payload, due_at)
+            restore = self._handlers.get(kind, (None, None))[1]
+            if restore:
+                restore(payload)
+        if rows:
+            logger.info(f"Восстановлено отложенных задач: {len(rows)}")
+    
+    def _fire(self, key, kind, payload):
+        self._persist(key, None, None, None)
+        handler = self._handlers.get(kind, (None, None))[0]
+        if handler is None:
+            logger.warning(f"Нет обработчика для таймера {key} типа {kind}")
+            return
+        
+        async def run():
+            try:
+                await handler(self.bot, payload)
+            except Exception as e:
+                logger.error(f"Ошибка при выполнении отложенной задачи {key}: {e}", exc_info=True)
+        
+        task = asyncio.create_task(run())
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.tick
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            slot = self._slots[self._cursor]
+            for key, entry in list(slot.items()):
+                if entry[0] > 0:
+                    entry[0] -= 1
+                    continue
+                del slot[key]
+                del self._index[key]
+                self._fire(key, entry[1], entry[2])
+    
+    async def start(self, bot):
+        """Загружает сохраненные таймеры и запускает обработку колеса"""
+        self.bot = bot
+        await self._load()
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Останавливает планировщик и дописывает изменения таймеров в базу"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self._writer.stop()
+        self._task = None
+
+
+# Общий планировщик отложенных задач бота
+scheduler = TimerWheel()
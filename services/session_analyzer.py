@@ -1,66 +1,185 @@
 import asyncio
+import heapq
+import json
+import random
 import time
+from collections import deque
 import logging
-from datetime import datetime
-from openai import AsyncOpenAI
+from datetime import datetime, timedelta
 from config.settings import settings
-from database.models import get_user
+from database.models import get_user, get_messages_since, get_unanalyzed_sessions, mark_session_analyzed
+from services.llm_client import create_llm_client
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, 
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Инициализация клиента OpenAI
-client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
+# Общий клиент OpenAI, передается из bot.py при запуске
+client = None
 
-# Словарь для хранения активных сессий
-# Структура: {user_id: {'messages': [], 'last_activity': timestamp, 'analyzed': False}}
+def set_client(llm_client):
+    """Устанавливает общий клиент OpenAI для анализатора"""
+    global client
+    # Повторы выполняет request_analysis, поэтому собственные повторы клиента отключены:
+    # иначе одна неудачная сессия дает (LEAD_ANALYSIS_MAX_RETRIES + 1) * (OPENAI_MAX_RETRIES + 1) запросов.
+    # Копия клиента использует тот же пул соединений
+    client = llm_client.with_options(max_retries=0)
+
+def _get_client():
+    if client is None:
+        set_client(create_llm_client())
+    return client
+
+class SessionState:
+    """
+    Краткая сводка об активной сессии пользователя.
+    
+    Сами сообщения хранятся в таблице messages и загружаются только при анализе,
+    поэтому сессии можно восстановить после перезапуска бота.
+    """
+    __slots__ = ('user_id', 'started_at', 'last_activity', 'message_count', 'analyzed', 'attempts')
+    
+    def __init__(self, user_id, started_at, last_activity, message_count=0):
+        self.user_id = user_id
+        self.started_at = started_at  # время начала сессии в формате messages.time_added
+        self.last_activity = last_activity
+        self.message_count = message_count
+        self.analyzed = False
+        self.attempts = 0  # неудачных попыток анализа
+
+# Словарь активных сессий: {user_id: SessionState}
 active_sessions = {}
 
 # Таймаут сессии в секундах (10 минут)
 SESSION_TIMEOUT = 15
 
-async def add_message_to_session(user_id, user_message, bot_response):
-    """Добавляет сообщение в сессию пользователя"""
+# Очередь сроков истечения сессий: (last_activity + SESSION_TIMEOUT, user_id).
+# Устаревшие записи (после новой активности пользователя) пропускаются при извлечении.
+session_deadlines = []
+
+# Событие для пробуждения анализатора, когда появляется более ранний срок истечения
+deadline_added = asyncio.Event()
+
+# Очередь истекших сессий, которые разбирают воркеры анализа
+analysis_queue = asyncio.Queue()
+
+# Ограничение одновременных запросов к OpenAI со стороны анализатора
+llm_semaphore = asyncio.Semaphore(settings.LEAD_ANALYSIS_MAX_CONCURRENT_REQUESTS)
+
+# Сессии, анализ которых не удался после всех повторов: {'user_id', 'session', 'error', 'time'}
+# (session - SessionState). Периодически возвращаются в очередь анализа (см. retry_dead_letters)
+dead_letters = deque(maxlen=settings.LEAD_DEAD_LETTER_SIZE)
+
+async def request_analysis(messages, **kwargs):
+    """Запрос к модели анализа с ограничением параллельности и повторами с экспоненциальной задержкой"""
+    for attempt in range(settings.LEAD_ANALYSIS_MAX_RETRIES + 1):
+        try:
+            async with llm_semaphore:
+                return await _get_client().chat.completions.create(
+                    model="gpt-3.5-turbo",
+                    messages=messages,
+                    **kwargs
+                )
+        except Exception as e:
+            if attempt == settings.LEAD_ANALYSIS_MAX_RETRIES:
+                raise
+            # Случайная добавка к задержке разводит повторы разных воркеров во времени
+            delay = settings.LEAD_ANALYSIS_RETRY_DELAY * 2 ** attempt
+            delay += random.uniform(0, settings.LEAD_ANALYSIS_RETRY_DELAY)
+            logger.warning(f"Ошибка запроса анализа (попытка {attempt + 1}): {e}, повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+def schedule_session(session):
+    """Планирует анализ сессии на момент ее истечения"""
+    deadline = session.last_activity + SESSION_TIMEOUT
+    if not session_deadlines or deadline < session_deadlines[0][0]:
+        deadline_added.set()
+    heapq.heappush(session_deadlines, (deadline, session.user_id))
+
+async def add_message_to_session(user_id, user_message, bot_response, time_added=None):
+    """
+    Отмечает новое сообщение в сессии пользователя.
+    
+    Текст сообщения уже сохранен (или поставлен в очередь записи) в таблице messages,
+    в памяти обновляется только сводка.
+    
+    Args:
+        time_added (str): Время сообщения, с которым оно записано в messages.time_added;
+            с него начинается новая сессия
+    """
     current_time = time.time()
+    session = active_sessions.get(user_id)
     
     # Если у пользователя нет активной сессии или она истекла, создаем новую
-    if user_id not in active_sessions or (current_time - active_sessions[user_id]['last_activity']) > SESSION_TIMEOUT:
-        active_sessions[user_id] = {
-            'messages': [],
-            'last_activity': current_time,
-            'analyzed': False
-        }
-    
-    # Добавляем сообщение в сессию
-    active_sessions[user_id]['messages'].append({
-        'user': user_message,
-        'bot': bot_response,
-        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    })
+    if session is None or (current_time - session.last_activity) > SESSION_TIMEOUT:
+        started_at = time_added or datetime.fromtimestamp(current_time).strftime('%Y-%m-%d %H:%M:%S')
+        session = SessionState(user_id, started_at, current_time)
+        active_sessions[user_id] = session
     
-    # Обновляем время последней активности
-    active_sessions[user_id]['last_activity'] = current_time
+    session.message_count += 1
+    session.last_activity = current_time
+    schedule_session(session)
     logger.debug(f"Сообщение добавлено в сессию пользователя {user_id}")
 
+async def restore_sessions():
+    """
+    Восстанавливает после перезапуска сессии с непроанализированными сообщениями.
+    
+    Учитываются сообщения за последние settings.SESSION_RESTORE_WINDOW секунд;
+    истекшие сессии будут проанализированы сразу после запуска анализатора.
+    
+    Returns:
+        int: Количество восстановленных сессий
+    """
+    since = (datetime.now() - timedelta(seconds=settings.SESSION_RESTORE_WINDOW)).strftime('%Y-%m-%d %H:%M:%S')
+    count = 0
+    for user_id, first_time, last_time, message_count in await get_unanalyzed_sessions(since):
+        if user_id in active_sessions:
+            continue
+        last_activity = datetime.strptime(last_time, '%Y-%m-%d %H:%M:%S').timestamp()
+        session = SessionState(user_id, first_time, last_activity, message_count)
+        active_sessions[user_id] = session
+        schedule_session(session)
+        count += 1
+    if count:
+        logger.info(f"Восстановлено непроанализированных сессий: {count}")
+    return count
+
+async def load_session_messages(session):
+    """Загружает из базы сообщения сессии в формате для build_dialog_text"""
+    rows = await get_messages_since(session.user_id, session.started_at)
+    return [{'user': message_text, 'bot': response_text, 'time': time_added}
+            for message_text, response_text, time_added in rows]
+
+async def mark_analyzed(session, messages):
+    """Отмечает сессию проанализированной в памяти и в базе"""
+    session.analyzed = True
+    if messages:
+        await mark_session_analyzed(session.user_id, messages[-1]['time'])
+
+def build_dialog_text(messages):
+    """Формирует текст диалога для анализа"""
+    dialog_text = ""
+    for msg in messages:
+        dialog_text += f"Пользователь [{msg['time']}]: {msg['user']}\n"
+        dialog_text += f"Бот: {msg['bot']}\n\n"
+    return dialog_text
+
 async def analyze_session(user_id):
     """Анализирует сессию диалога и определяет потребности пользователя"""
-    if user_id not in active_sessions or active_sessions[user_id]['analyzed']:
+    session = active_sessions.get(user_id)
+    if session is None or session.analyzed:
         return None
     
-    session = active_sessions[user_id]
-    messages = session['messages']
+    messages = await load_session_messages(session)
     
     if not messages or len(messages) < 1:  # Если меньше 2 сообщений, анализировать нечего
-        session['analyzed'] = True
+        session.analyzed = True
         return None
     
     # Формируем диалог для анализа
-    dialog_text = ""
-    for i, msg in enumerate(messages):
-        dialog_text += f"Пользователь [{msg['time']}]: {msg['user']}\n"
-        dialog_text += f"Бот: {msg['bot']}\n\n"
+    dialog_text = build_dialog_text(messages)
     
     # Формируем промпт для GPT
     prompt = f"""Проанализируй следующий диалог между чат-ботом и пользователем.
@@ -86,8 +205,7 @@ async def analyze_session(user_id):
     
     try:
         # Отправляем запрос к GPT
-        response = await client.chat.completions.create(
-            model="gpt-3.5-turbo",
+        response = await request_analysis(
             messages=[
                 {"role": "system", "content": '''Ты - аналитик диалогов,
                  который определяет потребности клиентов и их интерес к покупке курсов и других продуктов.
@@ -104,7 +222,7 @@ async def analyze_session(user_id):
         is_lead = "нет интереса к покупке курса" not in analysis_text.lower()
         
         # Отмечаем сессию как проанализированную
-        session['analyzed'] = True
+        await mark_analyzed(session, messages)
         
         if is_lead:
             logger.info(f"Пользователь {user_id} определен как потенциальный клиент")
@@ -116,9 +234,112 @@ async def analyze_session(user_id):
         logger.info(f"Пользователь {user_id} не проявляет интереса к покупке")
         return None
     except Exception as e:
+        # Ошибку обрабатывает process_session: сессия попадет в список неудачных анализов
         logger.error(f"Ошибка при анализе сессии для пользователя {user_id}: {e}", exc_info=True)
-        session['analyzed'] = True  # Отмечаем как проанализированную, чтобы не пытаться снова
-        return None
+        raise
+
+# Инструкция для пакетного анализа: передается один раз на несколько диалогов
+BATCH_ANALYSIS_PROMPT = """Проанализируй каждый из следующих диалогов между чат-ботом и пользователем.
+
+Для каждого диалога определи:
+1. Проявляет ли пользователь интерес к покупке курса (или другого продукта) и к какому именно.
+2. Какие конкретные вопросы задал пользователь.
+3. На какой стадии воронки продаж (внимание, интерес, сравнение, решение, покупка) находится пользователь.
+4. Что может помочь ускорить его решение о покупке (аргументы, предложения, кейсы, звонок, консультация).
+
+Ответь строго в формате JSON:
+{"results": [{"session_id": <номер диалога>, "is_lead": <true, если есть интерес к покупке, иначе false>,
+"interest": "<продукт, которым интересуется пользователь, или пустая строка>",
+"summary": "<резюме для менеджера до 5 предложений: вопросы пользователя, стадия воронки, что учесть при контакте и стоит ли подключать живого менеджера>"}]}
+В results должна быть ровно одна запись для каждого диалога.
+"""
+
+def parse_batch_analysis(content, session_ids):
+    """
+    Разбирает JSON-ответ пакетного анализа.
+    
+    Returns:
+        dict: session_id -> {'is_lead': bool, 'interest': str, 'summary': str}
+    
+    Raises:
+        ValueError: Если ответ не соответствует ожидаемой схеме
+    """
+    results = {}
+    try:
+        data = json.loads(content)
+        for item in data['results']:
+            if not isinstance(item.get('is_lead'), bool):
+                raise ValueError(f"Некорректное поле is_lead: {item!r}")
+            results[int(item['session_id'])] = {
+                'is_lead': item['is_lead'],
+                'interest': str(item.get('interest') or ''),
+                'summary': str(item.get('summary') or '')
+            }
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"Ответ не соответствует схеме: {e!r}") from e
+    if set(results) != set(session_ids):
+        raise ValueError(f"Ожидались результаты для {sorted(session_ids)}, получены для {sorted(results)}")
+    return results
+
+async def analyze_sessions_batch(user_ids):
+    """
+    Анализирует несколько сессий одним запросом со структурированным ответом.
+    
+    Returns:
+        list: Результаты анализа для сессий потенциальных клиентов
+    
+    Raises:
+        ValueError: Если ответ не удалось разобрать
+        Exception: Если запрос не удался
+    """
+    sessions = {user_id: active_sessions[user_id] for user_id in user_ids
+                if user_id in active_sessions and not active_sessions[user_id].analyzed}
+    dialogs_by_user = {}
+    for user_id, session in list(sessions.items()):
+        messages = await load_session_messages(session)
+        if not messages:
+            session.analyzed = True
+            del sessions[user_id]
+            continue
+        dialogs_by_user[user_id] = messages
+    if not sessions:
+        return []
+    
+    # Диалоги нумеруются по порядку, чтобы не передавать модели ID пользователей
+    numbered = dict(enumerate(sessions, start=1))
+    dialogs = "\n".join(
+        f"=== ДИАЛОГ {number} ===\n{build_dialog_text(dialogs_by_user[user_id])}"
+        for number, user_id in numbered.items()
+    )
+    
+    response = await request_analysis(
+        messages=[
+            {"role": "system", "content": "Ты - аналитик диалогов, который определяет потребности клиентов "
+                                          "и их интерес к покупке курсов и других продуктов. Отвечай только JSON."},
+            {"role": "user", "content": f"{BATCH_ANALYSIS_PROMPT}\n{dialogs}"}
+        ],
+        response_format={"type": "json_object"},
+        max_tokens=300 * len(numbered)
+    )
+    parsed = parse_batch_analysis(response.choices[0].message.content, numbered.keys())
+    
+    leads = []
+    for number, user_id in numbered.items():
+        result = parsed[number]
+        await mark_analyzed(sessions[user_id], dialogs_by_user[user_id])
+        if not result['is_lead']:
+            logger.info(f"Пользователь {user_id} не проявляет интереса к покупке")
+            continue
+        logger.info(f"Пользователь {user_id} определен как потенциальный клиент")
+        analysis_text = result['summary']
+        if result['interest']:
+            analysis_text = f"Интерес: {result['interest']}\n\n{analysis_text}"
+        leads.append({
+            "user_id": user_id,
+            "analysis_text": analysis_text,
+            "is_lead": True
+        })
+    return leads
 
 async def format_lead_message(analysis_result):
     """Форматирует сообщение о потенциальном клиенте для менеджера"""
@@ -181,61 +402,153 @@ async def send_message_to_manager(bot, text):
             logger.error(f"Не удалось отправить уведомление администратору: {ex}")
         return False
 
-async def cleanup_sessions():
-    """Удаляет проанализированные и устаревшие сессии из памяти"""
-    current_time = time.time()
-    users_to_remove = []
-    
-    for user_id, session in active_sessions.items():
-        # Удаляем проанализированные сессии
-        if session['analyzed']:
-            users_to_remove.append(user_id)
-        # Удаляем очень старые сессии (более 24 часов)
-        elif (current_time - session['last_activity']) > 86400:  # 24 часа
-            users_to_remove.append(user_id)
-    
-    # Удаляем сессии из словаря
-    for user_id in users_to_remove:
-        if user_id in active_sessions:
-            del active_sessions[user_id]
-    
-    if users_to_remove:
-        logger.info(f"Очищено {len(users_to_remove)} сессий из памяти")
+def pop_expired_sessions(current_time):
+    """Извлекает из очереди пользователей, чьи сессии истекли и еще не проанализированы"""
+    expired = []
+    while session_deadlines and session_deadlines[0][0] <= current_time:
+        deadline, user_id = heapq.heappop(session_deadlines)
+        session = active_sessions.get(user_id)
+        # Пропускаем записи, устаревшие из-за новой активности, и уже обработанные сессии
+        if session and not session.analyzed and session.last_activity + SESSION_TIMEOUT == deadline:
+            expired.append(user_id)
+    return expired
 
-async def check_inactive_sessions(bot):
-    """Проверяет неактивные сессии и анализирует их"""
-    current_time = time.time()
+async def process_session(bot, user_id):
+    """Анализирует истекшую сессию и отправляет менеджеру информацию о потенциальном клиенте"""
+    try:
+        logger.info(f"Обнаружена неактивная сессия пользователя {user_id}, начинаем анализ")
+        # Анализируем сессию
+        analysis_result = await analyze_session(user_id)
+        
+        if analysis_result and analysis_result["is_lead"]:
+            # Если это потенциальный клиент, форматируем сообщение для менеджера
+            lead_message = await format_lead_message(analysis_result)
+            
+            if lead_message:
+                # Отправляем сообщение менеджеру
+                await send_message_to_manager(bot, lead_message)
+    except Exception as e:
+        logger.error(f"Ошибка при обработке сессии пользователя {user_id}: {e}", exc_info=True)
+        await add_dead_letter(user_id, e)
+    finally:
+        release_session(user_id)
+
+async def add_dead_letter(user_id, error):
+    """Сохраняет сессию в список неудачных, если попытки ее анализа не исчерпаны"""
+    session = active_sessions.get(user_id)
+    if session is None:
+        return
+    session.attempts += 1
+    if session.attempts >= settings.LEAD_DEAD_LETTER_MAX_ATTEMPTS:
+        logger.error(f"Анализ сессии пользователя {user_id} не удался {session.attempts} раз, сессия отброшена")
+        # Отмечаем сессию в базе, иначе restore_sessions снова поставит ее в анализ после перезапуска
+        session.analyzed = True
+        try:
+            await mark_session_analyzed(user_id, datetime.fromtimestamp(session.last_activity).strftime('%Y-%m-%d %H:%M:%S'))
+        except Exception as e:
+            logger.error(f"Не удалось отметить отброшенную сессию пользователя {user_id}: {e}")
+        return
+    dead_letters.append({
+        'user_id': user_id,
+        'session': session,
+        'error': str(error),
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    })
+
+def release_session(user_id):
+    """Удаляет обработанную сессию из памяти, если пользователь не начал новую"""
+    session = active_sessions.get(user_id)
+    if session and time.time() - session.last_activity >= SESSION_TIMEOUT:
+        del active_sessions[user_id]
+
+async def process_sessions_batch(bot, user_ids):
+    """
+    Анализирует пачку сессий (в том числе из одной сессии) одним запросом со структурированным
+    ответом. Если ответ не удалось разобрать, каждая сессия анализируется отдельно в свободной
+    форме; если не удался сам запрос, сессии попадают в список неудачных.
+    """
+    try:
+        leads = await analyze_sessions_batch(user_ids)
+    except ValueError as e:
+        logger.warning(f"Ответ пакетного анализа не разобран ({e}), анализируем сессии по одной")
+        for user_id in user_ids:
+            await process_session(bot, user_id)
+        return
+    except Exception as e:
+        logger.error(f"Ошибка пакетного анализа сессий {user_ids}: {e}", exc_info=True)
+        for user_id in user_ids:
+            await add_dead_letter(user_id, e)
+            release_session(user_id)
+        return
     
-    for user_id, session in list(active_sessions.items()):
+    for analysis_result in leads:
         try:
-            # Если сессия неактивна более указанного таймаута и не проанализирована
-            if (current_time - session['last_activity']) > SESSION_TIMEOUT and not session['analyzed']:
-                logger.info(f"Обнаружена неактивная сессия пользователя {user_id}, начинаем анализ")
-                # Анализируем сессию
-                analysis_result = await analyze_session(user_id)
-                
-                if analysis_result and analysis_result["is_lead"]:
-                    # Если это потенциальный клиент, форматируем сообщение для менеджера
-                    lead_message = await format_lead_message(analysis_result)
-                    
-                    if lead_message:
-                        # Отправляем сообщение менеджеру
-                        await send_message_to_manager(bot, lead_message)
+            lead_message = await format_lead_message(analysis_result)
+            if lead_message:
+                await send_message_to_manager(bot, lead_message)
         except Exception as e:
-            logger.error(f"Ошибка при обработке сессии пользователя {user_id}: {e}", exc_info=True)
-            # Отмечаем сессию как проанализированную, чтобы не пытаться снова
-            session['analyzed'] = True
+            logger.error(f"Ошибка при отправке лида {analysis_result['user_id']}: {e}", exc_info=True)
+    for user_id in user_ids:
+        release_session(user_id)
 
-async def start_session_analyzer(bot):
-    """Запускает периодическую проверку неактивных сессий"""
-    logger.info("Запущен анализатор сессий")
+async def retry_dead_letters():
+    """Возвращает сессии из списка неудачных в очередь анализа"""
+    count = 0
+    while dead_letters:
+        item = dead_letters.popleft()
+        # Не затираем новую сессию, если пользователь успел снова написать
+        if item['user_id'] not in active_sessions:
+            item['session'].analyzed = False
+            active_sessions[item['user_id']] = item['session']
+            analysis_queue.put_nowait(item['user_id'])
+            count += 1
+    return count
+
+async def dead_letter_retrier():
+    """Раз в settings.LEAD_DEAD_LETTER_RETRY_INTERVAL секунд повторяет анализ неудачных сессий"""
+    while True:
+        await asyncio.sleep(settings.LEAD_DEAD_LETTER_RETRY_INTERVAL)
+        count = await retry_dead_letters()
+        if count:
+            logger.info(f"Повторный анализ неудачных сессий: {count}")
+
+async def check_inactive_sessions(bot):
+    """Ставит в очередь анализа только истекшие сессии"""
+    for user_id in pop_expired_sessions(time.time()):
+        analysis_queue.put_nowait(user_id)
+
+async def analysis_worker(bot):
+    """Воркер, анализирующий сессии из очереди пачками до settings.LEAD_BATCH_SIZE"""
     while True:
+        user_ids = [await analysis_queue.get()]
+        while len(user_ids) < settings.LEAD_BATCH_SIZE and not analysis_queue.empty():
+            user_ids.append(analysis_queue.get_nowait())
         try:
-            await check_inactive_sessions(bot)
-            await cleanup_sessions()  # Очищаем проанализированные и устаревшие сессии
-        except Exception as e:
-            logger.error(f"Ошибка в цикле анализа сессий: {e}", exc_info=True)
-        
-        # Проверяем каждую минуту
-        await asyncio.sleep(60)
+            await process_sessions_batch(bot, user_ids)
+        finally:
+            for _ in user_ids:
+                analysis_queue.task_done()
 
+async def start_session_analyzer(bot):
+    """Запускает анализатор, который просыпается к моменту истечения ближайшей сессии"""
+    logger.info("Запущен анализатор сессий")
+    workers = [asyncio.create_task(analysis_worker(bot)) for _ in range(settings.LEAD_ANALYSIS_WORKERS)]
+    workers.append(asyncio.create_task(dead_letter_retrier()))
+    try:
+        while True:
+            # Сбрасываем событие до обработки, чтобы не пропустить сессии, добавленные во время анализа
+            deadline_added.clear()
+            try:
+                await check_inactive_sessions(bot)
+            except Exception as e:
+                logger.error(f"Ошибка в цикле анализа сессий: {e}", exc_info=True)
+            
+            # Спим до истечения ближайшей сессии или до появления более ранней
+            timeout = max(0.0, session_deadlines[0][0] - time.time()) if session_deadlines else None
+            try:
+                await asyncio.wait_for(deadline_added.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for worker in workers:
+            worker.cancel()
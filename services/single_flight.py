@@ -0,0 +1,147 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """Выполняемый общий запрос и его ожидающие"""
+    __slots__ = ('task', 'started', 'waiters', 'parts', 'done', 'error', 'changed')
+
+    def __init__(self):
+        self.task = None
+        self.started = time.monotonic()
+        self.waiters = 0
+        # Для потоковых запросов: полученные фрагменты и событие о появлении новых
+        self.parts = []
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Event()
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных запросов.
+
+    Первый запрос с ключом выполняет работу в отдельной задаче, остальные запросы с тем же
+    ключом ждут ее результат. Присоединиться к запросу можно в течение timeout секунд
+    после его начала; присоединившийся ждет не дольше оставшегося времени и затем
+    выполняет запрос сам. Общая задача отменяется, только когда ее перестали ждать все.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._flights = {}  # ключ -> _Flight
+        self.leaders = 0
+        self.followers = 0
+
+    def _join(self, key):
+        flight = self._flights.get(key)
+        if flight and not flight.done and time.monotonic() - flight.started < self.timeout:
+            self.followers += 1
+            return flight
+        return None
+
+    def _start(self, key, make_coro):
+        flight = _Flight()
+        flight.task = asyncio.create_task(make_coro(flight))
+        self._flights[key] = flight
+        self.leaders += 1
+
+        def on_done(task):
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.done = True
+            # Ошибку получают ожидающие; помечаем ее обработанной, чтобы asyncio не предупреждал
+            if not task.cancelled():
+                task.exception()
+
+        flight.task.add_done_callback(on_done)
+        return flight
+
+    def _release(self, key, flight):
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            flight.task.cancel()
+            # Отменяемая задача завершится только на следующем шаге цикла событий -
+            # новые запросы с тем же ключом не должны к ней присоединиться
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def _remaining(self, flight):
+        return max(0.0, flight.started + self.timeout - time.monotonic())
+
+    async def run(self, key, factory):
+        """
+        Выполняет factory() или присоединяется к уже выполняющемуся запросу с тем же ключом.
+
+        Args:
+            key: Ключ запроса
+            factory: Функция без аргументов, возвращающая корутину
+        """
+        flight = self._join(key)
+        timeout = None
+        if flight is None:
+            flight = self._start(key, lambda flight: factory())
+        else:
+            timeout = self._remaining(flight)
+        flight.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight.task), timeout)
+        except asyncio.TimeoutError:
+            if timeout is None:
+                raise
+        finally:
+            self._release(key, flight)
+        logger.warning(f"Не дождались общего запроса за {self.timeout} с, выполняем запрос отдельно")
+        return await factory()
+
+    async def stream(self, key, factory):
+        """
+        Потоковый вариант run: все ожидающие получают фрагменты по мере их появления.
+
+        Args:
+            key: Ключ запроса
+            factory: Функция без аргументов, возвращающая асинхронный генератор
+        """
+        flight = self._join(key)
+        first_part_timeout = None
+        if flight is None:
+            flight = self._start(key, lambda flight: self._pump(flight, factory()))
+        else:
+            first_part_timeout = self._remaining(flight)
+        flight.waiters += 1
+        index = 0
+        try:
+            while True:
+                while index < len(flight.parts):
+                    yield flight.parts[index]
+                    index += 1
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                changed = flight.changed
+                try:
+                    await asyncio.wait_for(changed.wait(), first_part_timeout if index == 0 else None)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            self._release(key, flight)
+        logger.warning(f"Не дождались начала общего ответа за {self.timeout} с, выполняем запрос отдельно")
+        async for part in factory():
+            yield part
+
+    async def _pump(self, flight, generator):
+        """Читает фрагменты общего потока и будит ожидающих"""
+        try:
+            async for part in generator:
+                flight.parts.append(part)
+                changed, flight.changed = flight.changed, asyncio.Event()
+                changed.set()
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            flight.changed.set()
@@ -0,0 +1,97 @@
+import asyncio
+
+
+class _Lane:
+    """Очередь сообщений одного пользователя"""
+    __slots__ = ('lock', 'pending', 'generation', 'task')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = []  # тексты сообщений, на которые еще не отправлен ответ
+        self.generation = 0  # номер последнего пришедшего сообщения
+        self.task = None  # выполняющаяся генерация ответа
+
+
+class UserLanes:
+    """
+    Последовательная обработка сообщений каждого пользователя.
+
+    Сообщения одного пользователя обрабатываются по одному. На сообщение, пришедшее, когда
+    пользователь ничего не ждет, ответ начинается сразу. Новое сообщение отменяет генерацию
+    ответа на предыдущие, если она еще не завершилась, и ответ начинается не раньше чем через
+    debounce секунд после последнего сообщения: несколько сообщений, отправленных подряд,
+    объединяются в один вопрос.
+    """
+
+    def __init__(self, debounce):
+        self.debounce = debounce
+        self._lanes = {}  # user_id -> _Lane
+        self.merged = 0
+        self.superseded = 0
+
+    async def run(self, user_id, text, generate, complete):
+        """
+        Добавляет сообщение в очередь пользователя и, если за время ожидания не пришло
+        новых сообщений, отвечает на все накопленные сообщения разом.
+
+        Args:
+            user_id: ID пользователя
+            text (str): Текст сообщения
+            generate: Функция от объединенного вопроса, возвращающая корутину генерации
+                ответа; может быть отменена следующим сообщением
+            complete: Функция от (вопрос, результат generate), возвращающая корутину
+                сохранения ответа; выполняется до обработки следующего сообщения
+
+        Returns:
+            bool: True, если этот вызов ответил пользователю, False - если сообщение
+                  передано в следующий вопрос
+        """
+        lane = self._lanes.get(user_id)
+        if lane is None:
+            lane = self._lanes[user_id] = _Lane()
+        # Очередь свободна: нет ни других сообщений без ответа, ни ответа в процессе
+        idle = not lane.pending and not lane.lock.locked()
+        lane.pending.append(text)
+        lane.generation += 1
+        generation = lane.generation
+        if lane.task is not None and lane.task.cancel():
+            self.superseded += 1
+
+        if not idle:
+            # Пользователь пишет несколько сообщений подряд - ждем, пока он закончит
+            await asyncio.sleep(self.debounce)
+            if lane.generation != generation:
+                return False
+
+        async with lane.lock:
+            # Пока ждали завершения предыдущего ответа, могло прийти новое сообщение
+            if lane.generation != generation:
+                return False
+            count = len(lane.pending)
+            query = '\n'.join(lane.pending)
+
+            lane.task = asyncio.create_task(generate(query))
+            try:
+                # asyncio.wait не пробрасывает отмену задачи, в отличие от await
+                await asyncio.wait({lane.task})
+            except asyncio.CancelledError:
+                lane.task.cancel()
+                raise
+            if lane.task.cancelled():
+                return False
+
+            del lane.pending[:count]
+            self.merged += count - 1
+            try:
+                await complete(query, lane.task.result())
+            finally:
+                if lane.generation == generation and not lane.pending:
+                    self._lanes.pop(user_id, None)
+        return True
+
+    def stats(self):
+        return {
+            'users': len(self._lanes),
+            'merged': self.merged,
+            'superseded': self.superseded,
+        }